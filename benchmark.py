@@ -0,0 +1,376 @@
+"""
+Script to benchmark the encryption and decryption of folders.
+
+Synthetic folder trees are generated on a local disk (or tmpfs, e.g. with
+`--workdir=/dev/shm`) and then encrypted and decrypted with `encrypt.run` and
+`decrypt.run`. Each of them runs in a fresh process, so that its peak memory
+usage can be measured. The separate stages of a run are timed in isolation on
+the same tree:
+
+    walk        traversing the source folder
+    rsa         encrypting and decrypting the AES secret of a session
+    aes         encrypting every file without storing the result
+    write       copying every file, i.e. the cost of the disk I/O alone
+    cleanup     removing the copied files and folders, as an in-place
+                encryption does with the clear text files
+
+Additionally, `encrypt_file` and `decrypt_file` are timed with every chunk
+size given. The results are output as JSON, so that they can be compared
+between releases. Will work on both Windows and Linux, although the peak
+memory usage is only reported on Unix.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import multiprocessing
+import concurrent.futures
+import Crypto
+from Crypto.PublicKey import RSA
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows
+import encrypt
+import decrypt
+
+KB = 1024
+MB = 1024 * KB
+
+# The parts of each tree as (number of files, size of each file, depth of the
+# folders the files are spread over)
+TREES = {
+    "huge": [(4, 64 * MB, 0)],
+    "tiny": [(5000, 256, 1)],
+    "deep": [(500, 16 * KB, 32)],
+    "mixed": [(2, 16 * MB, 0), (1000, 256, 2), (100, 16 * KB, 16),
+              (50, 1 * MB, 4)],
+}
+
+
+def make_tree(folder, parts, scale=1.0):
+    """ Generates a folder tree with files of random data.
+
+    Arguments:
+        folder          The folder where the tree will be generated
+        parts           List of (number of files, file size, depth), see
+                        `TREES`
+        scale           Factor to multiply the number of files with
+
+    Return:
+        files           The number of generated files
+        total_size      The total size of the generated files
+    """
+    files = 0
+    total_size = 0
+    for part, (count, size, depth) in enumerate(parts):
+        for i in range(max(1, int(count * scale))):
+            # Spread the files over all the levels of the part
+            level = i % (depth + 1)
+            subfolders = ["p%d" % part] + ["d%d" % d for d in range(level)]
+            dirpath = os.path.join(folder, *subfolders)
+            os.makedirs(dirpath, exist_ok=True)
+            with open(os.path.join(dirpath, "f%d" % i), "wb") as clear_file:
+                remaining = size
+                while remaining > 0:
+                    chunk = min(remaining, MB)
+                    clear_file.write(os.urandom(chunk))
+                    remaining -= chunk
+            files += 1
+            total_size += size
+    return files, total_size
+
+
+def list_files(folder):
+    """ Returns the paths of all the files under the folder. """
+    return [os.path.join(dirpath, name)
+            for dirpath, _, filenames in os.walk(folder)
+            for name in filenames]
+
+
+def peak_rss():
+    """ Returns the peak memory usage (KiB) of this process and its children.
+
+    Return:
+        The sum of the peak resident set sizes or None if not supported
+    """
+    if not resource:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == "darwin":
+        return (usage + children) // KB  # Reported in bytes
+    return usage + children
+
+
+def timed(function, *args, **kwargs):
+    """ Calls the function and returns the elapsed wall-clock seconds. """
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def throughput(seconds, files, total_size):
+    """ Describes the duration of processing the given files. """
+    return {
+        "seconds": round(seconds, 6),
+        "mb_per_s": round(total_size / MB / seconds, 3) if seconds else None,
+        "files_per_s": round(files / seconds, 3) if seconds else None,
+    }
+
+
+def run_case(function, *args):
+    """ Runs encrypt.run or decrypt.run, meant to run in a fresh process.
+
+    Return:
+        seconds         The elapsed wall-clock time
+        rss             The peak memory usage in KiB, see `peak_rss`
+    """
+    with open(os.devnull, "w") as devnull:
+        # Do not measure how fast the paths are printed
+        with contextlib.redirect_stdout(devnull):
+            seconds = timed(function, *args)
+    return seconds, peak_rss()
+
+
+def isolated(function, *args):
+    """ Calls `run_case` in a new process, so its memory usage is its own. """
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) \
+            as executor:
+        return executor.submit(run_case, function, *args).result()
+
+
+def time_stages(source, workdir, public_key, private_key):
+    """ Times the stages of an encryption in isolation.
+
+    Arguments:
+        source          The folder with the clear text files
+        workdir         A folder for temporary files
+        public_key      Path to the public key
+        private_key     Path to the private key
+
+    Return:
+        stages          Dictionary with the seconds spent in every stage
+    """
+    stages = dict()
+    filenames = list_files(source)
+    aes_secret = os.urandom(32)
+
+    stages["walk"] = timed(list_files, source)
+
+    def rsa():
+        cipher = encrypt.load_public_key(public_key)
+        secret = encrypt.encrypt_string(aes_secret, cipher)
+        decrypt.decrypt_string(secret, private_key)
+    stages["rsa"] = timed(rsa)
+
+    def aes():
+        for filename in filenames:
+            encrypt.encrypt_file(aes_secret, filename, os.devnull)
+    stages["aes"] = timed(aes)
+
+    copies = os.path.join(workdir, "copies")
+    stages["write"] = timed(shutil.copytree, source, copies)
+
+    def cleanup():
+        for filename in list_files(copies):
+            os.remove(filename)
+        shutil.rmtree(copies)
+    stages["cleanup"] = timed(cleanup)
+
+    return {stage: round(seconds, 6) for stage, seconds in stages.items()}
+
+
+def time_chunksizes(source, workdir, chunksizes):
+    """ Times encrypt_file and decrypt_file with different chunk sizes.
+
+    Return:
+        results         Dictionary with the throughput of every chunk size
+    """
+    filenames = list_files(source)
+    total_size = sum(os.path.getsize(filename) for filename in filenames)
+    aes_secret = os.urandom(32)
+    encrypted = os.path.join(workdir, "chunk.enc")
+    decrypted = os.path.join(workdir, "chunk.dec")
+    results = dict()
+    for chunksize in chunksizes:
+        encrypt_seconds = 0
+        decrypt_seconds = 0
+        for filename in filenames:
+            encrypt_seconds += timed(encrypt.encrypt_file, aes_secret,
+                                     filename, encrypted, chunksize)
+            decrypt_seconds += timed(decrypt.decrypt_file, aes_secret,
+                                     encrypted, decrypted, chunksize)
+        results[str(chunksize)] = {
+            "encrypt": throughput(encrypt_seconds, len(filenames),
+                                  total_size),
+            "decrypt": throughput(decrypt_seconds, len(filenames),
+                                  total_size),
+        }
+    for filename in (encrypted, decrypted):
+        if os.path.exists(filename):
+            os.remove(filename)
+    return results
+
+
+def benchmark_tree(name, workdir, public_key, private_key, scale=1.0, jobs=1,
+                   chunksizes=(64 * KB,)):
+    """ Benchmarks the encryption and decryption of a synthetic tree.
+
+    Arguments:
+        name            The name of the tree, see `TREES`
+        workdir         The folder where the tree will be generated
+        public_key      Path to the public key
+        private_key     Path to the private key
+        scale           Factor to multiply the number of files with
+        jobs            The number of files to encrypt in parallel
+        chunksizes      The chunk sizes to time the single files with
+
+    Return:
+        result          Dictionary with the measurements of the tree
+    """
+    folder = os.path.join(workdir, name)
+    source = os.path.join(folder, "source")
+    encrypted = os.path.join(folder, "encrypted")
+    decrypted = os.path.join(folder, "decrypted")
+    for path in (source, encrypted, decrypted):
+        os.makedirs(path)
+    files, total_size = make_tree(source, TREES[name], scale)
+
+    result = {"tree": name, "files": files, "bytes": total_size}
+    seconds, rss = isolated(encrypt.run, source, encrypted, public_key, jobs)
+    result["encrypt"] = dict(throughput(seconds, files, total_size),
+                             peak_rss_kib=rss)
+    seconds, rss = isolated(decrypt.run, encrypted, decrypted, None,
+                            private_key, jobs)
+    result["decrypt"] = dict(throughput(seconds, files, total_size),
+                             peak_rss_kib=rss)
+    result["stages"] = time_stages(source, folder, public_key, private_key)
+    result["chunksizes"] = time_chunksizes(source, folder, chunksizes)
+
+    shutil.rmtree(folder)
+    return result
+
+
+def generate_keys(folder):
+    """ Generates a key pair in the folder, as `generate_keys` does.
+
+    Return:
+        public_key      Path to the public key
+        private_key     Path to the private key
+    """
+    private_key = RSA.generate(2048)
+    public_key_file = os.path.join(folder, "key.public")
+    private_key_file = os.path.join(folder, "key.private")
+    with open(public_key_file, "wb") as public_file:
+        public_file.write(private_key.publickey().exportKey())
+    with open(private_key_file, "wb") as private_file:
+        private_file.write(private_key.exportKey())
+    return public_key_file, private_key_file
+
+
+def run(trees, workdir=None, scale=1.0, jobs=1, chunksizes=(64 * KB,),
+        public_key=None, private_key=None):
+    """ Benchmarks the given trees.
+
+    Arguments:
+        trees           The names of the trees to benchmark, see `TREES`
+        workdir         The folder where the trees will be generated, a
+                        temporary folder is used if None
+        scale           Factor to multiply the number of files with
+        jobs            The number of files to encrypt in parallel
+        chunksizes      The chunk sizes to time the single files with
+        public_key      Path to the public key, a new key pair is generated
+                        if either of the keys is not given
+        private_key     Path to the private key
+
+    Return:
+        report          Dictionary with the environment and the results
+    """
+    workdir = tempfile.mkdtemp(prefix="cryptopuck-benchmark-", dir=workdir)
+    try:
+        if not (public_key and private_key):
+            public_key, private_key = generate_keys(workdir)
+        results = []
+        for name in trees:
+            print("Benchmarking: " + name, file=sys.stderr)
+            results.append(benchmark_tree(name, workdir, public_key,
+                                          private_key, scale, jobs,
+                                          chunksizes))
+    finally:
+        shutil.rmtree(workdir)
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "pycryptodome": Crypto.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scale": scale,
+        "jobs": jobs,
+        "results": results,
+    }
+
+
+def parse_chunksizes(chunksizes):
+    """ Parses a comma separated list of chunk sizes. """
+    try:
+        values = [int(value) for value in chunksizes.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected SIZE[,SIZE...], got: " +
+                                         chunksizes)
+    if any(value <= 0 or value % 16 for value in values):
+        raise argparse.ArgumentTypeError("Chunk sizes must be positive and "
+                                         "divisible by 16: " + chunksizes)
+    return values
+
+
+def main():
+    parser_description = "Benchmark the encryption and decryption"
+    parser = argparse.ArgumentParser(description=parser_description)
+    parser.add_argument("--trees", nargs="+", choices=sorted(TREES),
+                        default=sorted(TREES),
+                        help="The synthetic trees to benchmark")
+    workdir_message = "Path to the directory where the trees will be \
+    generated, e.g. a tmpfs mount. The system's temporary directory is used \
+    if none provided."
+    parser.add_argument("--workdir", help=workdir_message)
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Factor to multiply the number of files with")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of files to encrypt in parallel")
+    parser.add_argument("--chunksizes", type=parse_chunksizes,
+                        default=[24 * KB, 64 * KB, 256 * KB],
+                        help="Comma separated chunk sizes to time the \
+                        single files with")
+    keys_message = "Path to the public key. A new key pair is generated if \
+    either of the keys is not provided."
+    parser.add_argument("--public-key", help=keys_message)
+    parser.add_argument("--private-key", help="Path to the private key")
+    parser.add_argument("--output",
+                        help="Path to the JSON report, printed if none \
+                        provided")
+    args = parser.parse_args()
+
+    if args.workdir and not os.path.isdir(args.workdir):
+        print("Workdir does not exist or not a directory:", args.workdir)
+        sys.exit(1)
+
+    report = run(args.trees, args.workdir, args.scale, args.jobs,
+                 args.chunksizes, args.public_key, args.private_key)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Module to pack many small files into a single encrypted file (bundle).
+
+Creating, writing and closing a separate encrypted file for every small file
+is dominated by the metadata operations of the filesystem, which are very
+slow on FAT32/exFAT drives. Instead, small files can be concatenated and
+encrypted as a single bundle. The record of every packed file in the
+filenames map (see the `manifest` module) has the obscured name of the bundle
+along with the `offset` and `length` of the file within it, so the files can
+be unpacked with a single sequential read of the bundle. Will work on both
+Windows and Linux.
+"""
+
+# Files up to this size are packed
+MAX_PACKED_SIZE = 64 * 1024
+# A bundle is completed once it reaches either of these limits
+BUNDLE_SIZE = 8 * 1024 * 1024
+BUNDLE_FILES = 4096
+
+
+def is_packed(record):
+    """ Checks whether a record of the filenames map is in a bundle. """
+    return "offset" in record
+
+
+class BundleReader():
+    def __init__(self, files):
+        """ Reads multiple files as a single concatenated one.
+
+        Arguments:
+            files       List of (path, size) of the files to be packed. Exactly
+                        `size` bytes are read from every file.
+        """
+        self.files = iter(files)
+        self.file = None
+        self.path = None
+        self.remaining = 0
+
+    def readinto(self, buffer):
+        """ Reads data into the buffer.
+
+        Return:
+            length      The number of bytes read, 0 after the last file
+        """
+        while not self.remaining:
+            if self.file:
+                self.file.close()
+                self.file = None
+            path, size = next(self.files, (None, 0))
+            if path is None:
+                return 0
+            self.file = open(path, "rb")
+            self.path = path
+            self.remaining = size
+        view = memoryview(buffer)[:self.remaining]
+        length = self.file.readinto(view)
+        if not length:
+            raise ValueError("File changed while being packed: " + self.path)
+        self.remaining -= length
+        return length
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BundleWriter():
+    def __init__(self, entries):
+        """ Unpacks the files while a bundle is written to it.
+
+        Arguments:
+            entries     List of (offset, length, path) of the files to be
+                        unpacked, which may be only some of the packed ones.
+                        Their folders should already exist.
+        """
+        self.entries = sorted(entries)
+        self.current = 0  # The entry being written
+        self.position = 0
+        self.file = None
+
+    def write(self, data):
+        view = memoryview(data)
+        while self.current < len(self.entries):
+            offset, length, path = self.entries[self.current]
+            # Skip the data of the files that are not unpacked
+            if self.position < offset:
+                skipped = min(offset - self.position, len(view))
+                view = view[skipped:]
+                self.position += skipped
+                if self.position < offset:
+                    break
+            if self.file is None:
+                self.file = open(path, "wb")
+            written = min(offset + length - self.position, len(view))
+            self.file.write(view[:written])
+            view = view[written:]
+            self.position += written
+            if self.position < offset + length:
+                break
+            self.file.close()
+            self.file = None
+            self.current += 1
+        self.position += len(view)
+
+    def tell(self):
+        """ Returns the size of the bundle that has been written so far. """
+        return self.position
+
+    def finish(self):
+        """ Creates the empty files at the end of the bundle. """
+        self.write(b"")
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
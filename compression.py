@@ -0,0 +1,144 @@
+"""
+Module to compress the files before they are encrypted.
+
+Encrypted data cannot be compressed, so files such as logs or CSVs have to be
+compressed (with zlib) before they are encrypted in order to write fewer bytes
+to the drive. Files that are already compressed or otherwise have a high
+entropy (e.g. JPEG, ZIP or video) are detected by compressing a few samples of
+them and are encrypted as they are, so that no CPU time is wasted on them.
+Whether a file was compressed is recorded in the header of the encrypted file
+(see the `container` module). Will work on both Windows and Linux.
+"""
+
+import os
+import zlib
+import itertools
+
+# The fastest level, since compressing should not be slower than writing
+DEFAULT_LEVEL = 1
+# Smaller files occupy a single cluster of the filesystem anyway
+MIN_SIZE = 4096
+SAMPLE_SIZE = 64 * 1024
+SAMPLES = 3
+# The compressed samples must be smaller than this ratio of their size
+MAX_RATIO = 0.9
+
+
+def is_compressible(filename, samples=SAMPLES, sample_size=SAMPLE_SIZE,
+                    max_ratio=MAX_RATIO):
+    """ Checks whether compressing the file would be worth it.
+
+    Arguments:
+        filename        Path to the clear text file
+        samples         The number of samples, spread evenly over the file
+        sample_size     The size of each sample
+        max_ratio       The highest ratio of the compressed to the original
+                        size of the samples for the file to be compressed
+
+    Return:
+        True if the file should be compressed, False otherwise
+    """
+    filesize = os.path.getsize(filename)
+    if filesize < MIN_SIZE:
+        return False
+    sampled = 0
+    compressed = 0
+    with open(filename, "rb") as infile:
+        spacing = (filesize - sample_size) // max(1, samples - 1)
+        step = max(sample_size, spacing)
+        for position in range(0, filesize, step)[:samples]:
+            infile.seek(position)
+            sample = infile.read(sample_size)
+            sampled += len(sample)
+            compressed += len(zlib.compress(sample, DEFAULT_LEVEL))
+    return compressed < sampled * max_ratio
+
+
+def are_compressible(files, samples=SAMPLES, sample_size=SAMPLE_SIZE,
+                     max_ratio=MAX_RATIO):
+    """ Checks whether compressing files packed together would be worth it.
+
+    Every sample is read from consecutive files, starting from files spread
+    evenly over the list, like the packed data would be.
+
+    Arguments:
+        files           List of (path, size) of the clear text files, in the
+                        order they are packed
+        samples         The number of samples
+        sample_size     The size of each sample
+        max_ratio       The highest ratio of the compressed to the original
+                        size of the samples for the files to be compressed
+
+    Return:
+        True if the files should be compressed, False otherwise
+    """
+    if sum(size for _, size in files) < MIN_SIZE:
+        return False
+    sampled = 0
+    compressed = 0
+    step = max(1, len(files) // samples)
+    for first in range(0, len(files), step)[:samples]:
+        sample = bytearray()
+        for path, _ in itertools.islice(files, first, None):
+            with open(path, "rb") as infile:
+                sample += infile.read(sample_size - len(sample))
+            if len(sample) >= sample_size:
+                break
+        sampled += len(sample)
+        compressed += len(zlib.compress(sample, DEFAULT_LEVEL))
+    return compressed < sampled * max_ratio
+
+
+class CompressingReader():
+    def __init__(self, infile, level=DEFAULT_LEVEL, chunksize=64*1024):
+        """ Wraps a file so that its compressed contents are read.
+
+        Arguments:
+            infile      The clear text file object
+            level       The zlib compression level
+            chunksize   The size of the chunks read from the file
+        """
+        self.infile = infile
+        self.chunk = bytearray(chunksize)
+        self.compressor = zlib.compressobj(level)
+        self.pending = memoryview(b"")
+        self.eof = False
+
+    def readinto(self, buffer):
+        """ Reads compressed data into the buffer.
+
+        Return:
+            length      The number of bytes read, 0 at the end of the stream
+        """
+        while not self.pending and not self.eof:
+            length = self.infile.readinto(self.chunk)
+            if length:
+                chunk = memoryview(self.chunk)[:length]
+                self.pending = memoryview(self.compressor.compress(chunk))
+            else:
+                self.pending = memoryview(self.compressor.flush())
+                self.eof = True
+        length = min(len(buffer), len(self.pending))
+        buffer[:length] = self.pending[:length]
+        self.pending = self.pending[length:]
+        return length
+
+
+class DecompressingWriter():
+    def __init__(self, outfile):
+        """ Wraps a file so that the data written to it is decompressed.
+
+        Arguments:
+            outfile     The clear text file object
+        """
+        self.outfile = outfile
+        self.decompressor = zlib.decompressobj()
+
+    def write(self, data):
+        self.outfile.write(self.decompressor.decompress(data))
+
+    def finish(self):
+        """ Writes any remaining data and checks the stream is complete. """
+        self.outfile.write(self.decompressor.flush())
+        if not self.decompressor.eof or self.decompressor.unused_data:
+            raise ValueError("Incomplete compressed stream")
@@ -0,0 +1,208 @@
+"""
+Module describing the format of the encrypted files.
+
+Files are split in fixed size segments and each segment is encrypted and
+authenticated independently with AES (GCM mode). This way any part of a file
+can be decrypted without having to decrypt everything before it. The layout
+of an encrypted file is:
+
+    header      magic, version, flags, segment size, original file size and
+                a random nonce prefix (see `HEADER`)
+    segment 0   ciphertext of up to `segment_size` bytes followed by its tag
+    segment 1   ...
+
+The nonce of every segment is the nonce prefix of the file followed by the
+index of the segment, while the header is authenticated along with every
+segment. Therefore segments cannot be reordered, moved to other files or have
+their header tampered with. If the file was compressed before it was
+encrypted, the segments contain the compressed stream instead, while the size
+in the header is the one of the decompressed file. Files encrypted with the
+legacy format (size, IV and a single AES-CBC stream) do not start with the
+magic bytes, since their first 8 bytes are the size of the file. Will work on
+both Windows and Linux.
+"""
+
+import os
+import struct
+import collections
+from Crypto.Cipher import AES
+
+# The last byte of the magic is not zero, so it cannot be mistaken for the
+# little endian size of a legacy file
+MAGIC = b"\x89CPK\r\n\x1a\n"
+VERSION = 1
+# Magic, version, flags, reserved, segment size, file size, nonce prefix
+HEADER = struct.Struct("<8sBBHIQ8s")
+TAG_SIZE = 16
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+# A segment is held in memory while it is encrypted or decrypted
+MAX_SEGMENT_SIZE = 16 * 1024 * 1024
+# The segments contain the zlib compressed file, see the `compression` module
+FLAG_COMPRESSED = 0x01
+FLAGS = FLAG_COMPRESSED
+
+Header = collections.namedtuple("Header", ["flags", "segment_size",
+                                           "filesize", "nonce_prefix", "raw"])
+
+
+def new_header(filesize, segment_size=DEFAULT_SEGMENT_SIZE, flags=0):
+    """ Creates the header of a new encrypted file.
+
+    Arguments:
+        filesize        The size of the clear text file
+        segment_size    The size of the clear text in each segment
+        flags           Flags describing how the clear text was processed
+
+    Return:
+        header          The header with a new random nonce prefix
+    """
+    check_segment_size(segment_size)
+    nonce_prefix = os.urandom(8)
+    raw = HEADER.pack(MAGIC, VERSION, flags, 0, segment_size, filesize,
+                      nonce_prefix)
+    return Header(flags, segment_size, filesize, nonce_prefix, raw)
+
+
+def is_container(infile):
+    """ Checks whether the file is in the segmented format.
+
+    The position of the file is left unchanged.
+
+    Arguments:
+        infile          The (seekable) encrypted file object
+
+    Return:
+        True if the file starts with the magic bytes, False otherwise
+    """
+    position = infile.tell()
+    magic = infile.read(len(MAGIC))
+    infile.seek(position)
+    return magic == MAGIC
+
+
+def read_header(infile):
+    """ Reads the header of an encrypted file.
+
+    Arguments:
+        infile          The encrypted file object, positioned at its beginning
+
+    Return:
+        header          The parsed header
+    """
+    return parse_header(infile.read(HEADER.size))
+
+
+def parse_header(raw):
+    """ Parses the raw header of an encrypted file.
+
+    Arguments:
+        raw             The first `HEADER.size` bytes of the encrypted file
+
+    Return:
+        header          The parsed header
+    """
+    if len(raw) != HEADER.size:
+        raise ValueError("Truncated header")
+    magic, version, flags, _, segment_size, filesize, nonce_prefix = \
+        HEADER.unpack(raw)
+    if magic != MAGIC:
+        raise ValueError("Not an encrypted container")
+    if version != VERSION:
+        raise ValueError("Unsupported container version: %d" % version)
+    if flags & ~FLAGS:
+        raise ValueError("Unsupported container flags: %d" % flags)
+    check_segment_size(segment_size)
+    return Header(flags, segment_size, filesize, nonce_prefix, raw)
+
+
+def check_segment_size(segment_size):
+    """ Checks that a segment size can be encrypted and decrypted.
+
+    Arguments:
+        segment_size    The size of the clear text in each segment
+
+    Return:
+        Raises ValueError unless the size is a positive multiple of the AES
+        block size that is not larger than `MAX_SEGMENT_SIZE`
+    """
+    if not 0 < segment_size <= MAX_SEGMENT_SIZE or \
+            segment_size % AES.block_size:
+        raise ValueError("Invalid segment size: %d" % segment_size)
+
+
+def segment_cipher(key, header, index):
+    """ Creates the cipher for a single segment.
+
+    Arguments:
+        key             The AES secret
+        header          The header of the file
+        index           The index of the segment in the file
+
+    Return:
+        cipher          The AES (GCM mode) cipher of the segment
+    """
+    nonce = header.nonce_prefix + struct.pack(">I", index)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+    cipher.update(header.raw)
+    return cipher
+
+
+def encrypt_segment(key, header, index, segment, length):
+    """ Encrypts a segment in place and appends its tag.
+
+    Arguments:
+        key             The AES secret
+        header          The header of the file
+        index           The index of the segment in the file
+        segment         Bytearray with the clear text at its beginning and
+                        room for the tag after it
+        length          The size of the clear text
+
+    Return:
+        length          The size of the encrypted segment, including the tag
+    """
+    cipher = segment_cipher(key, header, index)
+    view = memoryview(segment)[:length]
+    cipher.encrypt(view, output=view)
+    segment[length:length + TAG_SIZE] = cipher.digest()
+    return length + TAG_SIZE
+
+
+def decrypt_segment(key, header, index, segment, length):
+    """ Decrypts and authenticates a segment in place.
+
+    Arguments:
+        key             The AES secret
+        header          The header of the file
+        index           The index of the segment in the file
+        segment         Bytearray with the encrypted segment at its beginning
+        length          The size of the encrypted segment, including the tag
+
+    Return:
+        length          The size of the clear text. A ValueError is raised if
+                        the segment is truncated or has been tampered with.
+    """
+    length -= TAG_SIZE
+    if length <= 0:
+        raise ValueError("Truncated segment: %d" % index)
+    cipher = segment_cipher(key, header, index)
+    view = memoryview(segment)
+    cipher.decrypt(view[:length], output=view[:length])
+    cipher.verify(view[length:length + TAG_SIZE])
+    return length
+
+
+def segment_offset(header, index):
+    """ Returns the position of a segment in the encrypted file. """
+    return HEADER.size + index * (header.segment_size + TAG_SIZE)
+
+
+def segment_count(header, payload_size):
+    """ Returns the number of segments needed for the payload size. """
+    return -(-payload_size // header.segment_size)
+
+
+def encrypted_size(header, payload_size):
+    """ Returns the size of the encrypted file for the payload size. """
+    segments = segment_count(header, payload_size)
+    return HEADER.size + payload_size + segments * TAG_SIZE
@@ -4,53 +4,323 @@ Script that detects mounted volumes and encrypts them.
 The script contains the main business logic of Cryptopuck. Using inotify it
 watches the given mountpoint for new volumes and when they are mounted it calls
 the `encrypt` module to encrypt it. Additionally, it handles the LED blinking
-that indicates the operational state of the Cryptopuck. Will work on Linux.
+that indicates the operational state of the Cryptopuck. Everything is driven
+by a single asyncio event loop, while the encryption itself runs in executors,
+so no CPU time is spent while waiting for new volumes. Will work on Linux.
 """
 
 import os
+import re
 import sys
 import getpass
 import pyinotify
 import time
+import json
 import argparse
 import enum
-import threading
+import asyncio
+import functools
 import subprocess
+import concurrent.futures
+import collections
 import encrypt
+import durability
+import progress
 if getpass.getuser() == "pi":
     import RPi.GPIO as GPIO
 
+# The number of seconds between the updates of the status file
+STATUS_INTERVAL = 1
+
 
 class EventHandler(pyinotify.ProcessEvent):
-    def __init__(self, public_key, led_manager):
-        self.public_key = public_key
-        self.led_manager = led_manager
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
 
     def process_IN_CREATE(self, event):
+        # Called from the event loop, so it should never block
         if os.path.isdir(event.pathname):
             print("New mounted volume detected: " + event.pathname)
+            # Encrypt the volume without blocking the detection of new ones
+            self.scheduler.submit(event.pathname)
+
+
+class JobState(enum.Enum):
+    """ The states of a volume encryption job """
+    QUEUED = 0
+    ENCRYPTING = 1
+    DONE = 2
+    ERROR = 3
+
+
+class Job():
+    def __init__(self, mountpoint):
+        """ The encryption of a single mounted volume.
+
+        Arguments:
+            mountpoint  The path where the volume is mounted
+        """
+        self.mountpoint = mountpoint
+        self.device = None
+        self.state = JobState.QUEUED
+        self.error = None
+        # The latest progress of the encryption, see the `progress` module
+        self.progress = None
+
+    def set_progress(self, snapshot):
+        """ Called from the thread that encrypts the volume. """
+        self.progress = snapshot
+
+    def to_dict(self):
+        """ Describes the job for the status file. """
+        return {
+            "mountpoint": self.mountpoint,
+            "device": self.device,
+            "state": self.state.name,
+            "error": str(self.error) if self.error else None,
+            "progress": self.progress,
+        }
+
+
+class JobScheduler():
+    def __init__(self, loop, public_key, led_manager, jobs=1, device_jobs=1,
+                 status_file=None, log_interval=None, compress=False,
+                 durability_mode=durability.STRICT):
+        """ Encrypts each mounted volume as a separate job.
+
+        Volumes on different devices are encrypted at the same time, while the
+        number of volumes encrypted at the same time on a single device is
+        limited so they do not compete for its bandwidth. All the jobs share
+        the same pool of worker processes.
+
+        Arguments:
+            loop        The asyncio event loop the jobs are scheduled in
+            public_key  The public key cipher (see `encrypt.load_public_key`)
+                        to be used for the encryption
+            led_manager The LedManager that indicates the operational state
+            jobs        The number of worker processes shared by all the jobs
+            device_jobs The number of volumes of the same device that can be
+                        encrypted at the same time
+            status_file Path to a JSON file that is periodically updated
+                        with the state and progress of every job
+            log_interval The number of seconds between printing the progress
+                        of the running jobs, nothing is printed if None
+            compress    Whether to compress the files before encrypting them
+            durability_mode How the encrypted files are made durable before
+                        the originals are removed, see the `durability`
+                        module
+        """
+        self.loop = loop
+        self.public_key = public_key
+        self.led_manager = led_manager
+        self.jobs = jobs
+        self.device_jobs = device_jobs
+        self.compress = compress
+        self.durability_mode = durability_mode
+        self.executor = None
+        if jobs > 1:
+            self.executor = concurrent.futures.ProcessPoolExecutor(jobs)
+            # Start the worker processes now instead of when the first volume
+            # is mounted
+            for _ in range(jobs):
+                self.executor.submit(os.getpid).result()
+        self.device_limits = dict()
+        self.active_jobs = []
+        # The most recently completed jobs, kept for the status file
+        self.finished_jobs = collections.deque(maxlen=16)
+        self.failed = False
+        self.status_file = status_file
+        # Tracking the progress is only worth it if it is reported
+        self.report_progress = bool(status_file or log_interval)
+        if status_file:
+            self.write_status()
+            loop.create_task(self.report(STATUS_INTERVAL, self.write_status))
+        if log_interval:
+            loop.create_task(self.report(log_interval, self.log_progress))
+
+    def submit(self, mountpoint):
+        """ Starts encrypting the volume in the background.
+
+        Arguments:
+            mountpoint  The path where the volume is mounted
+
+        Return:
+            job         The Job of the volume
+        """
+        job = Job(mountpoint)
+        self.active_jobs.append(job)
+        # A new job clears any previous errors
+        self.failed = False
+        self.update_led()
+        self.loop.create_task(self.run(job))
+        return job
+
+    async def run(self, job):
+        """ Encrypts, syncs and unmounts the volume of the job. """
+        try:
             # Wait for the volume to be mounted and avoid permission errors
-            time.sleep(1)
-            # Encrypt the volume
+            if await wait_for_mount(job.mountpoint):
+                # Fails if the volume has been removed in the meantime
+                job.device = get_device(job.mountpoint)
+                if job.device not in self.device_limits:
+                    self.device_limits[job.device] = asyncio.Semaphore(
+                        self.device_jobs)
+                async with self.device_limits[job.device]:
+                    await self.process(job)
+            else:
+                print("Volume was not mounted in time: " + job.mountpoint)
+                job.state = JobState.ERROR
+        except Exception as e:
+            print(e)
+            job.state = JobState.ERROR
+            job.error = e
+        finally:
+            self.active_jobs.remove(job)
+            self.finished_jobs.append(job)
+            self.failed = self.failed or job.state == JobState.ERROR
+            self.update_led()
+
+    async def process(self, job):
+        """ Runs the blocking parts of the job outside of the event loop. """
+        job.state = JobState.ENCRYPTING
+        # Encrypt the volume
+        on_progress = job.set_progress if self.report_progress else None
+        try:
+            await self.loop.run_in_executor(None, functools.partial(
+                encrypt.run, job.mountpoint, job.mountpoint, self.public_key,
+                self.jobs, executor=self.executor,
+                on_progress=on_progress, compress=self.compress,
+                durability_mode=self.durability_mode))
+            print("Finished volume encryption: " + job.mountpoint)
+        except Exception as e:
+            print(e)
+            job.state = JobState.ERROR
+            job.error = e
+        # Unmount the volume, after flushing it in case the encryption failed
+        try:
+            print("Syncing " + job.mountpoint)
+            await self.loop.run_in_executor(None, durability.sync_volume,
+                                            job.mountpoint)
+            print("Unmounting " + job.mountpoint)
+            await self.loop.run_in_executor(None, run_system_cmd,
+                                            ["umount", job.mountpoint])
+        except Exception as e:
+            print(e)
+            job.state = JobState.ERROR
+            job.error = e
+        if job.state != JobState.ERROR:
+            job.state = JobState.DONE
+
+    async def report(self, interval, function):
+        """ Calls the function periodically, for as long as the loop runs. """
+        while True:
+            await asyncio.sleep(interval)
+            function()
+
+    def write_status(self):
+        """ Replaces the status file with the state of every job. """
+        status = {
+            "state": self.led_manager.get_state().name,
+            "active_jobs": [job.to_dict() for job in self.active_jobs],
+            "finished_jobs": [job.to_dict() for job in self.finished_jobs],
+        }
+        # Readers should never see a partially written file
+        temporary_file = self.status_file + ".tmp"
+        try:
+            with open(temporary_file, "w") as status_file:
+                json.dump(status, status_file, indent=2)
+            os.replace(temporary_file, self.status_file)
+        except OSError as e:
+            print("Could not write status file: " + str(e))
+
+    def log_progress(self):
+        """ Prints the progress of every running job. """
+        for job in self.active_jobs:
+            if job.progress:
+                print("Progress of " + job.mountpoint + ": " +
+                      progress.describe(job.progress))
+
+    def update_led(self):
+        """ Indicates the state of all the jobs through the LED. """
+        if self.failed:
+            self.led_manager.set_state(CryptopuckState.ERROR)
+        elif self.active_jobs:
             self.led_manager.set_state(CryptopuckState.ENCRYPTING)
-            try:
-                encrypt.run(event.pathname, event.pathname, self.public_key)
-                print("Finished volume encryption: " + event.pathname)
-            except Exception as e:
-                print(e)
-                self.led_manager.set_state(CryptopuckState.ERROR)
-            # Unmount the volume
-            try:
-                print("Syncing")
-                run_system_cmd("sync")
-                print("Unmounting " + event.pathname)
-                run_system_cmd("umount " + event.pathname)
-            except Exception as e:
-                print(e)
-                self.led_manager.set_state(CryptopuckState.ERROR)
+        else:
             # If everything went well, indicate success through the LED state
-            if self.led_manager.get_state() == CryptopuckState.ENCRYPTING:
-                self.led_manager.set_state(CryptopuckState.IDLE)
+            self.led_manager.set_state(CryptopuckState.IDLE)
+
+
+def is_mounted(path):
+    """ Checks whether a volume is mounted at path.
+
+    The mount points of /proc/self/mountinfo are used, or if it is not
+    available, whether path is on a different filesystem than its parent.
+
+    Arguments:
+        path        The path to check
+
+    Return:
+        True if a volume is mounted at path, False otherwise
+    """
+    path = os.path.realpath(path)
+    try:
+        with open("/proc/self/mountinfo", "r") as mountinfo:
+            for line in mountinfo:
+                # The mount point is the fifth field, with spaces and other
+                # special characters escaped as octal numbers
+                mount_point = line.split(" ")[4]
+                mount_point = re.sub(r"\\([0-7]{3})",
+                                     lambda match: chr(int(match.group(1), 8)),
+                                     mount_point)
+                if mount_point == path:
+                    return True
+        return False
+    except OSError:
+        return os.path.ismount(path)
+
+
+async def wait_for_mount(path, timeout=10, interval=0.05):
+    """ Waits until a volume is mounted at path and is writable.
+
+    Arguments:
+        path        The path where the volume is being mounted
+        timeout     The maximum time to wait in seconds
+        interval    The time between the checks in seconds
+
+    Return:
+        True if the volume is ready, False if the timeout expired
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        if is_mounted(path) and os.access(path, os.R_OK | os.W_OK | os.X_OK):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(interval)
+
+
+def get_device(path):
+    """ Finds the physical device (e.g. `sda`) of the volume mounted at path.
+
+    Partitions of the same device are resolved to the device itself. If the
+    device cannot be found, e.g. not on Linux, the ID of the filesystem is
+    returned instead.
+
+    Arguments:
+        path        Path where the volume is mounted
+
+    Return:
+        device      A name that identifies the device
+    """
+    dev = os.stat(path).st_dev
+    sys_path = "/sys/dev/block/%d:%d" % (os.major(dev), os.minor(dev))
+    if not os.path.exists(sys_path):
+        return str(dev)
+    sys_path = os.path.realpath(sys_path)
+    if os.path.isfile(os.path.join(sys_path, "partition")):
+        sys_path = os.path.dirname(sys_path)
+    return os.path.basename(sys_path)
 
 
 class CryptopuckState(enum.Enum):
@@ -80,53 +350,72 @@ class RpiLed():
 
 
 class LedManager():
-    def __init__(self, main_thread):
+    # How long the LED stays on and off while blinking in each state
+    BLINK_PATTERNS = {
+        CryptopuckState.ENCRYPTING: (0.1, 1),
+        CryptopuckState.ERROR: (0.1, 0.3),
+    }
+
+    def __init__(self):
         """ LED Manager's constructor, sets pin up using RPi.GPIO. """
-        # Monitor the main thread to stop if it has stopped
-        self.main_thread = main_thread
         # Set the type of LED to use
         self.led = RpiLed(40) if getpass.getuser() == "pi" else None
         # Set the initial operational state
         self.state = CryptopuckState.IDLE
+        # Wakes up the LED task when the state changes
+        self.state_changed = asyncio.Event()
 
     def set_state(self, state):
         """ Set the operational state using CryptopuckState. """
-        self.state = state
+        if state != self.state:
+            self.state = state
+            self.state_changed.set()
 
     def get_state(self):
         """ Get the currently set CryptopuckState. """
         return self.state
 
-    def run(self):
+    async def wait(self, timeout=None):
+        """ Sleeps until the timeout expires or the state changes.
+
+        Return:
+            True if the state changed, False otherwise
+        """
+        try:
+            await asyncio.wait_for(self.state_changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.state_changed.clear()
+        return True
+
+    async def run(self):
         """ The main business logic of the LED Manager.
 
-        Contains a blocking loop the controls the LED based on the internal
-        state machine.
+        Controls the LED based on the internal state machine. Timers are used
+        for blinking and the task is idle until the state changes otherwise.
         """
         # If the LED type is not defined, then do nothing
         if not self.led:
             return
         # Blink the LED differently depending on the operational state
-        while self.main_thread.is_alive():
+        while True:
             if self.state == CryptopuckState.IDLE:
                 self.led.turn_on()
-            elif self.state == CryptopuckState.ENCRYPTING:
-                self.led.turn_on()
-                time.sleep(0.1)
-                self.led.turn_off()
-                time.sleep(1)
-            elif self.state == CryptopuckState.ERROR:
-                self.led.turn_on()
-                time.sleep(0.1)
-                self.led.turn_off()
-                time.sleep(0.3)
+                await self.wait()
+                continue
+            on_time, off_time = self.BLINK_PATTERNS[self.state]
+            self.led.turn_on()
+            if await self.wait(on_time):
+                continue
+            self.led.turn_off()
+            await self.wait(off_time)
 
 
 def run_system_cmd(cmd):
-    """ Run system command using the shell.
+    """ Run system command without the shell.
 
     Arguments:
-        cmd         The shell command to be run
+        cmd         The command to be run and its arguments, as a list
 
     Return:
         0           Command was executed succefully
@@ -134,7 +423,7 @@ def run_system_cmd(cmd):
     """
     try:
         subprocess.check_output(cmd, stderr=subprocess.STDOUT,
-                                shell=True, universal_newlines=True)
+                                universal_newlines=True)
     except subprocess.CalledProcessError as e:
         print("ERROR:\n\n%s" % e.output)
         return 1
@@ -150,28 +439,66 @@ def main():
                         required=True)
     parser.add_argument("--public-key",
                         help="Path to the public key", required=True)
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of files to encrypt in parallel")
+    device_jobs_message = "Number of volumes of the same device to encrypt \
+    at the same time. Volumes of different devices are always encrypted at \
+    the same time."
+    parser.add_argument("--device-jobs", type=int, default=1,
+                        help=device_jobs_message)
+    status_file_message = "Path to a JSON file that is updated every second \
+    with the state, the files and bytes encrypted, the throughput, the \
+    estimated time left and the time spent per stage of every job."
+    parser.add_argument("--status-file", help=status_file_message)
+    parser.add_argument("--log-interval", type=float,
+                        help="Seconds between printing the progress of the \
+                        running jobs")
+    compress_message = "Compress the files before encrypting them, unless \
+    they are already compressed."
+    parser.add_argument("--compress", action="store_true",
+                        help=compress_message)
+    durability_message = "How the encrypted files are made durable before \
+    the originals are removed: `strict` (default), `batch` or `fast`. See \
+    `encrypt.py --help`."
+    parser.add_argument("--durability", choices=durability.MODES,
+                        default=durability.STRICT, help=durability_message)
     args = parser.parse_args()
 
     if not os.path.isdir(args.mountpoint):
         print("Mountpoint does not exist or not a directory:", args.mountpoint)
         sys.exit(1)
+    if not os.path.isfile(args.public_key):
+        print("Public key not found: " + args.public_key)
+        sys.exit(1)
+    # Parse the public key once, instead of for every volume
+    public_key = encrypt.load_public_key(args.public_key)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
 
     # Setup the Led Manager
-    main_thread = threading.current_thread()
-    led_manager = LedManager(main_thread)
-    led_thread = threading.Thread(target=led_manager.run)
-    led_thread.start()
+    led_manager = LedManager()
+    loop.create_task(led_manager.run())
 
     # Setup pyInotify
     wm = pyinotify.WatchManager()  # Watch Manager
     mask = pyinotify.IN_CREATE  # watched events
 
-    notifier = pyinotify.Notifier(wm, EventHandler(args.public_key,
-                                  led_manager))
+    scheduler = JobScheduler(loop, public_key, led_manager, args.jobs,
+                             args.device_jobs, args.status_file,
+                             args.log_interval, args.compress,
+                             args.durability)
+    notifier = pyinotify.AsyncioNotifier(wm, loop,
+                                         default_proc_fun=EventHandler(
+                                             scheduler))
     wdd = wm.add_watch(args.mountpoint, mask)
 
-    notifier.loop()  # Blocking loop
-    led_thread.join()
+    try:
+        loop.run_forever()  # Blocking loop
+    finally:
+        notifier.stop()
+        loop.close()
+
 
 if __name__ == "__main__":
     main()
@@ -9,20 +9,37 @@ both Windows and Linux.
 
 import sys
 import os
+import io
 import struct
 import argparse
 import json
-import tempfile
-from Crypto.Cipher import AES
+import itertools
+import shutil
+import fnmatch
+import tarfile
+import time
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
+from parallel import run_jobs, shared_executor
+import pipeline
+import compression
+import bundle
+import container
+import manifest
+import incremental
+import journal
+import progress
+import streams
+import volumes
 
 
-def decrypt_file(key, in_filename, out_filename=None, chunksize=24*1024):
-    """ Decrypts a file using AES (CBC mode) with the given key.
+def decrypt_file(key, in_filename, out_filename=None, chunksize=64*1024):
+    """ Decrypts a file using AES with the given key.
 
-        Adopted from Eli Bendersky's example:
-        http://eli.thegreenplace.net/2010/06/25/aes-encryption-of-files-in-python-with-pycrypto/
+        Both the segmented (see the `container` module) and the legacy file
+        formats are supported, while compressed files are decompressed. The
+        segments are authenticated as they are decrypted and a ValueError is
+        raised if the file has been tampered with or is truncated.
 
     Arguments:
         key             AES secret to decrypt the file.
@@ -31,24 +48,206 @@ def decrypt_file(key, in_filename, out_filename=None, chunksize=24*1024):
                         is supplied the decrypted file name will be the
                         original one minus the last ending
                         (e.g. example.txt.enc -> example.txt).
-        chunksize       Size of the chunks to read while decrypting.
+        chunksize       Size of the chunks to read while decrypting legacy
+                        files. Must be divisible by 16. Reading, decrypting and
+                        writing of the chunks are pipelined, see the
+                        `pipeline` module.
     """
     if not out_filename:
         out_filename = os.path.basename(os.path.splitext(in_filename)[0])
 
     with open(in_filename, 'rb') as infile:
-        origsize = struct.unpack('<Q', infile.read(struct.calcsize('Q')))[0]
-        iv = infile.read(16)
-        decryptor = AES.new(key, AES.MODE_CBC, iv)
+        if not container.is_container(infile):
+            decrypt_legacy_file(key, infile, out_filename, chunksize)
+            return
 
         with open(out_filename, 'wb') as outfile:
-            while True:
-                chunk = infile.read(chunksize)
-                if len(chunk) == 0:
-                    break
-                outfile.write(decryptor.decrypt(chunk))
+            decrypt_stream(key, infile, outfile, in_filename)
+
+
+def decrypt_bundle(key, in_filename, entries):
+    """ Unpacks the files of a bundle, see the `bundle` module.
+
+        The bundle is decrypted with a single sequential read.
+
+    Arguments:
+        key             AES secret to decrypt the bundle.
+        in_filename     Path to the encrypted bundle.
+        entries         List of (offset, length, path) of the files to be
+                        unpacked. Their folders should already exist.
+                        Entries with the same offset and length are copies
+                        of the same file.
+    """
+    # Copies of the same file are unpacked once and then copied
+    unpacked = dict()
+    copies = []
+    for offset, length, path in entries:
+        first = unpacked.setdefault((offset, length), path)
+        if first != path:
+            copies.append((first, path))
+
+    with open(in_filename, 'rb') as infile:
+        with bundle.BundleWriter([(offset, length, path) for
+                                  (offset, length), path in unpacked.items()]
+                                 ) as outfile:
+            decrypt_stream(key, infile, outfile, in_filename)
+            outfile.finish()
+    for first, path in copies:
+        shutil.copyfile(first, path)
+
+
+def decrypt_stream(key, infile, outfile, in_filename):
+    """ Decrypts a segmented file into a file object.
+
+    Arguments:
+        key             AES secret to decrypt the file.
+        infile          The encrypted file object, positioned at its beginning.
+        outfile         The file object to write the clear text to.
+        in_filename     Path to the encrypted file, for the error messages.
+    """
+    header = container.read_header(infile)
+    indices = itertools.count()
+
+    def decrypt_segment(segment, length):
+        if length <= container.TAG_SIZE:
+            raise ValueError("Truncated segment: " + in_filename)
+        return container.decrypt_segment(key, header, next(indices), segment,
+                                         length)
+
+    start = outfile.tell()
+    if header.flags & container.FLAG_COMPRESSED:
+        # Decompress in the writing stage of the pipeline
+        writer = compression.DecompressingWriter(outfile)
+        pipeline.run(infile, writer, decrypt_segment,
+                     header.segment_size + container.TAG_SIZE)
+        writer.finish()
+    else:
+        pipeline.run(infile, outfile, decrypt_segment,
+                     header.segment_size + container.TAG_SIZE)
+    if outfile.tell() - start != header.filesize:
+        raise ValueError("Truncated file: " + in_filename)
+
+
+def decrypt_legacy_file(key, infile, out_filename, chunksize=64*1024):
+    """ Decrypts a file that was encrypted as a single AES-CBC stream.
+
+        Adopted from Eli Bendersky's example:
+        http://eli.thegreenplace.net/2010/06/25/aes-encryption-of-files-in-python-with-pycrypto/
+
+    Arguments:
+        key             AES secret to decrypt the file.
+        infile          The encrypted file object, positioned at its beginning.
+        out_filename    The name (and path) of the decrypted file.
+        chunksize       Size of the chunks to read while decrypting.
+    """
+    reader = streams.DecryptingReader(key, infile, chunksize)
+
+    with open(out_filename, 'wb') as outfile:
+        # Decrypt in the reading stage of the pipeline
+        pipeline.run(reader, outfile, lambda chunk, length: length, chunksize)
+
+
+class DiscardingWriter():
+    """ File object that counts the data written to it and throws it away. """
+    def __init__(self):
+        self.position = 0
+
+    def write(self, data):
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+
+def verify_file(key, in_filename, min_size=0):
+    """ Checks that an encrypted file is intact, without writing it anywhere.
+
+        Segmented files are decrypted and authenticated as a whole, while
+        compressed ones are also decompressed, and the clear text is thrown
+        away. Legacy files are not authenticated, so only their size can be
+        checked against the original size stored in them.
+
+    Arguments:
+        key             AES secret to decrypt the file.
+        in_filename     Path to the encrypted file.
+        min_size        The size the decrypted file should at least have,
+                        e.g. the end of the last file packed in a bundle.
+
+    Return:
+        filesize        The size of the decrypted file. A ValueError is raised
+                        if the file is corrupted or truncated.
+    """
+    with open(in_filename, 'rb') as infile:
+        actual_size = os.fstat(infile.fileno()).st_size
+        if not container.is_container(infile):
+            if actual_size < struct.calcsize('Q') + 16:
+                raise ValueError("Truncated file: " + in_filename)
+            origsize = struct.unpack('<Q',
+                                     infile.read(struct.calcsize('Q')))[0]
+            # The size, the IV and the clear text padded to the AES block
+            expected_size = struct.calcsize('Q') + 16 + -(-origsize // 16) * 16
+            if actual_size != expected_size:
+                raise ValueError("Unexpected size: " + in_filename)
+            filesize = origsize
+        else:
+            header = container.read_header(infile)
+            infile.seek(0)
+            # Truncated files are detected without reading them
+            if not (header.flags & container.FLAG_COMPRESSED or
+                    actual_size == container.encrypted_size(header,
+                                                            header.filesize)):
+                raise ValueError("Unexpected size: " + in_filename)
+            decrypt_stream(key, infile, DiscardingWriter(), in_filename)
+            filesize = header.filesize
+    if filesize < min_size:
+        raise ValueError("Truncated file: " + in_filename)
+    return filesize
+
+
+def decrypt_range(key, in_filename, offset, length):
+    """ Decrypts only a part of an encrypted file.
+
+        For segmented files only the segments overlapping with the range are
+        read and authenticated, unless the file is compressed, in which case
+        it has to be decompressed from its beginning up to the range. Legacy
+        files are decrypted starting from the AES block containing the
+        offset, using the previous ciphertext block as the IV.
+
+    Arguments:
+        key             AES secret to decrypt the file.
+        in_filename     Path to the encrypted file.
+        offset          Position in the decrypted file to start from.
+        length          Number of bytes to decrypt.
+
+    Return:
+        data            The decrypted bytes, which may be fewer than `length`
+                        if the range goes past the end of the file
+    """
+    with open(in_filename, 'rb') as infile:
+        reader = streams.DecryptingReader(key, infile)
+        end = min(offset + length, reader.filesize)
+        if offset >= end:
+            return b''
+        reader.seek(offset)
+        data = bytearray(end - offset)
+        if pipeline.read_chunk(reader, data) != len(data):
+            raise ValueError("Truncated file: " + in_filename)
+        return bytes(data)
 
-            outfile.truncate(origsize)
+
+def load_private_key(private_key_file):
+    """ Reads and parses the private key, so it can be reused.
+
+    Arguments:
+        private_key_file        Path to the private key
+
+    Return:
+        cipher                  The RSA (PKCS#1 OAEP) cipher of the private key
+    """
+    with open(private_key_file, "r") as pvt_file:
+        pvt_key = RSA.importKey(pvt_file.read())
+
+    return PKCS1_OAEP.new(pvt_key)
 
 
 def decrypt_string(text_to_decrypt, private_key_file):
@@ -56,117 +255,887 @@ def decrypt_string(text_to_decrypt, private_key_file):
 
     Arguments:
         text_to_decrypt         The encrypted text
-        private_key_file        The private key to decrypt
+        private_key_file        The private key to decrypt, either a path or
+                                a cipher already loaded with
+                                `load_private_key`
 
     Return:
         decrypted_text          The decrypted text
     """
-    with open(private_key_file, "r") as pvt_file:
-        pvt_key = RSA.importKey(pvt_file.read())
-
-    cipher = PKCS1_OAEP.new(pvt_key)
+    if isinstance(private_key_file, str):
+        cipher = load_private_key(private_key_file)
+    else:
+        cipher = private_key_file
     decrypted_text = cipher.decrypt(text_to_decrypt)
     return decrypted_text
 
 
-def run(source, destination, secret, private_key="./key.private"):
-    """ Decrypts the source folder and outputs to the destination folder.
+def decrypt_job(key, in_filename, out_filename, remove_original=False,
+                packed_files=None, copies=()):
+    """ Decrypts a single file and optionally removes the encrypted original.
+
+        Module level so that it can be dispatched to worker processes.
 
         Arguments:
-            source          The folder to be decrypted
-            destination     The folder where the decrypted files will end up
-            secret          The (encrypted) secret used for the encryption
-            public_key      The private key to be used for the decryption
+            key             The AES secret to decrypt the file with
+            in_filename     Path to the encrypted file
+            out_filename    Path to the decrypted file to be generated, None
+                            for bundles
+            remove_original Whether the encrypted file should be removed after
+                            it has been decrypted
+            packed_files    List of (offset, length, path) of the files to be
+                            unpacked if the encrypted file is a bundle
+            copies          Paths where the decrypted file should be copied
+                            to, if the file had identical copies
     """
-    # Make sure that the source and destination folders finish with separator
-    if source[-1] != os.sep:
-        source += os.sep
-    if destination[-1] != os.sep:
-        destination += os.sep
+    if packed_files:
+        decrypt_bundle(key, in_filename, packed_files)
+    else:
+        decrypt_file(key, in_filename, out_filename)
+        for copy in copies:
+            shutil.copyfile(out_filename, copy)
+    if remove_original:
+        if os.path.exists(in_filename):
+            os.remove(in_filename)
+
+
+def load_secret(secret, private_key):
+    """ Decrypts the AES secret using the private key.
+
+    Arguments:
+        secret          Path to the (encrypted) secret used for the encryption
+        private_key     The private key to be used for the decryption, either
+                        a path or a cipher loaded with `load_private_key`
 
-    # Decrypt the AES secret
-    # Set default path if None provided
-    if not secret:
-        secret = source + "secret"
+    Return:
+        aes_secret      The decrypted AES secret
+    """
     # Check to see if there is actually an AES secret file
     if not os.path.isfile(secret):
-        print("Secret not found: " + secret)
-        sys.exit(1)
+        raise FileNotFoundError("Secret not found: " + secret)
     # Check to see if there is actually a private key file
-    if not os.path.isfile(private_key):
-        print("Private key not found: " + private_key)
-        sys.exit(1)
+    if isinstance(private_key, str) and not os.path.isfile(private_key):
+        raise FileNotFoundError("Private key not found: " + private_key)
     # Get the decrypted AES key
     with open(secret, "rb") as aes_secret_file:
         aes_secret = aes_secret_file.read()
-    decrypted_aes_secret = decrypt_string(aes_secret, private_key)
-
-    # We should restore the file structure, therefore we should parse the file
-    # containing the encrypted structure and create the appropriate filepaths.
-    # To do that we need to restore the mapping that contains the
-    # real to obscured paths combinations. The keys are the obscured filenames
-    # and the values are the real paths.
-    json_encrypted_map = source + "filenames_map"
-    # Dictionary to hold the mapping between encrypted and real paths
-    filenames_map = dict()
+    return decrypt_string(aes_secret, private_key)
+
+
+def load_sessions(source, secret=None, private_key="./key.private"):
+    """ Decrypts the AES secrets of all the sessions in the source folder.
+
+    Arguments:
+        source          The folder with the encrypted files, ending with a
+                        separator
+        secret          Path to the (encrypted) secret used for the encryption.
+                        If given, only its session is used, the one of its
+                        suffix (e.g. `secret.1`) or else the first one.
+        private_key     The private key to be used for the decryption, either
+                        a path or a cipher loaded with `load_private_key`
+
+    Return:
+        sessions        List of (decrypted AES secret, secret path, map path)
+                        for every session, in the order they were encrypted
+    """
+    if secret:
+        match = manifest.SESSION_FILE.match(os.path.basename(secret))
+        session = 0
+        if match and match.group(1) == manifest.SECRET_NAME:
+            session = int(match.group(2) or 0)
+        _, map_path = manifest.session_paths(source, session)
+        return [(load_secret(secret, private_key), secret, map_path)]
+    sessions = []
+    for session in manifest.find_sessions(source):
+        secret_path, map_path = manifest.session_paths(source, session)
+        sessions.append((load_secret(secret_path, private_key), secret_path,
+                         map_path))
+    if not sessions:
+        raise FileNotFoundError("Secret not found: " + source +
+                                manifest.SECRET_NAME)
+    return sessions
+
+
+def load_filenames_map(json_encrypted_map, key):
+    """ Opens the mapping between the obscured and the real filepaths.
+
+    Arguments:
+        json_encrypted_map  Path to the encrypted filenames map
+        key                 The decrypted AES secret
+
+    Return:
+        filenames_map       The manifest with the records of the obscured
+                            names and real paths (see the `manifest` module)
+                            or None if there is no filenames map
+    """
     if not os.path.isfile(json_encrypted_map):
         print("Warning: Will not restore file structure.")
         warning_msg = "Map between encrypted filenames and paths not found: "
         print(warning_msg + json_encrypted_map)
-    else:
-        # Unencrypt the json containing the filenames map into a temporary file
-        with tempfile.NamedTemporaryFile(mode="r+t") as tmp_json:
-            decrypt_file(decrypted_aes_secret, json_encrypted_map,
-                         tmp_json.name)
-            tmp_json.seek(0)  # Go to the beginning of the file to read again
-            filenames_map = json.load(tmp_json)
-
-    # Recursively unencrypt files in the source folder
-    for dirpath, dirnames, filenames in os.walk(source):
-        for name in filenames:
-            filename = os.path.join(dirpath, name)
-            # Do not unencrypt files that we have generated ourselves
-            if filename != secret and filename != json_encrypted_map:
-                # If the filenames mapping is defined, then we should use it
-                # to restore the original file structure
-                if filenames_map:
-                    # Get the real filename and its path
-                    destination_file = destination + filenames_map[name]
-                    # Create the necessary folder structure
-                    folder_structure = os.path.dirname(destination_file)
+        return None
+    if manifest.is_manifest(json_encrypted_map):
+        return manifest.ManifestReader(json_encrypted_map, key)
+
+    # Maps encrypted by previous versions are a single JSON object, which is
+    # decrypted in memory
+    with open(json_encrypted_map, "rb") as encrypted_map:
+        return manifest.LegacyManifest(
+            json.load(streams.DecryptingReader(key, encrypted_map)))
+
+
+def extract(source, filename, offset, length, secret=None,
+            private_key="./key.private"):
+    """ Decrypts a byte range of a single file in the source folder.
+
+        Arguments:
+            source          The folder with the encrypted files
+            filename        The original path of the file, relative to the
+                            encrypted folder, or its obscured name
+            offset          Position in the decrypted file to start from
+            length          Number of bytes to decrypt
+            secret          The (encrypted) secret used for the encryption
+            private_key     The private key to be used for the decryption
+
+        Return:
+            data            The decrypted bytes
+    """
+    if source[-1] != os.sep:
+        source += os.sep
+
+    # Look for the file in the latest sessions first
+    for key, _, map_path in reversed(load_sessions(source, secret,
+                                                   private_key)):
+        filenames_map = load_filenames_map(map_path, key)
+        if filenames_map is None:
+            continue
+        with filenames_map:
+            if filename in filenames_map:
+                return decrypt_range(key, source + filename, offset, length)
+            for record in filenames_map:
+                if record["path"] != filename:
+                    continue
+                if bundle.is_packed(record):
+                    # Only the part of the bundle with the file is decrypted
+                    length = max(0, min(length, record["length"] - offset))
+                    offset += record["offset"]
+                return decrypt_range(key, source + record["name"], offset,
+                                     length)
+
+    raise FileNotFoundError("File not found: " + filename)
+
+
+def is_selected(path, include=None, exclude=None):
+    """ Checks whether a file should be decrypted.
+
+        Patterns are matched against the original path of the file using
+        shell-style wildcards, where `*` matches path separators too. A
+        pattern without wildcards also matches every file under it if it is a
+        folder (e.g. `photos` matches `photos/2017/beach.jpg`).
+
+        Arguments:
+            path            The original path of the file
+            include         List of patterns of which at least one should
+                            match, or None to include every file
+            exclude         List of patterns of which none should match
+
+        Return:
+            True if the file is selected, False otherwise
+    """
+    def matches(pattern):
+        folder = pattern.rstrip("/" + os.sep)
+        return (fnmatch.fnmatchcase(path, pattern) or
+                path.startswith(folder + "/") or
+                path.startswith(folder + os.sep))
+
+    if include and not any(matches(pattern) for pattern in include):
+        return False
+    if exclude and any(matches(pattern) for pattern in exclude):
+        return False
+    return True
+
+
+def list_files(source, secret=None, private_key="./key.private",
+               include=None, exclude=None):
+    """ Lists the original paths of the encrypted files in the source folder.
+
+        Arguments:
+            source          The folder with the encrypted files
+            secret          The (encrypted) secret used for the encryption
+            private_key     The private key to be used for the decryption
+            include         Patterns of the paths to list, see `is_selected`
+            exclude         Patterns of the paths not to list
+
+        Return:
+            paths           Generator of the original paths
+    """
+    if source[-1] != os.sep:
+        source += os.sep
+    for key, _, map_path in load_sessions(source, secret, private_key):
+        filenames_map = load_filenames_map(map_path, key)
+        if filenames_map is None:
+            continue
+        with filenames_map:
+            for record in filenames_map:
+                if is_selected(record["path"], include, exclude):
+                    yield record["path"]
+
+
+def verify(source, secret=None, private_key="./key.private", jobs=1,
+           include=None, exclude=None):
+    """ Checks that the encrypted files in the source folder are intact.
+
+        Every encrypted file in the filenames maps is read and authenticated
+        (see `verify_file`) in parallel, without writing anything, so that it
+        is safe to remove the original files. The problems found are printed
+        as they are found.
+
+        Arguments:
+            source          The folder with the encrypted files
+            secret          The (encrypted) secret used for the encryption
+            private_key     The private key to be used for the decryption
+            jobs            The number of files to be verified in parallel
+            include         Patterns of the original paths to verify, see
+                            `is_selected`. Everything is verified if None.
+            exclude         Patterns of the original paths not to verify
+
+        Return:
+            verified        The number of intact encrypted files
+            missing         List of the original paths of the files whose
+                            encrypted file is missing
+            corrupted       List of (original path, error) of the files whose
+                            encrypted file (or filenames map) is corrupted
+            extra           List of the files in the source folder that are
+                            not in any filenames map
+    """
+    if source[-1] != os.sep:
+        source += os.sep
+    sessions = load_sessions(source, secret, private_key)
+
+    verified = 0
+    missing = []
+    corrupted = []
+    # The original paths of the files that are being verified
+    pending = dict()
+
+    def file_verified(key, in_filename, min_size):
+        nonlocal verified
+        verified += 1
+        del pending[in_filename]
+
+    def file_corrupted(error, key, in_filename, min_size):
+        if not isinstance(error, (ValueError, OSError)):
+            raise error
+        for path in pending.pop(in_filename):
+            print("Corrupted: %s (%s)" % (path, error))
+            corrupted.append((path, str(error)))
+
+    def verification_jobs(key, filenames_map):
+        """ Generates the arguments for every file in the filenames map. """
+        # The bundles and the files with copies have multiple records, which
+        # are all verified along with the first one
+        shared_names = filenames_map.shared_names()
+        verified_names = set()
+        for record in filenames_map:
+            name = record["name"]
+            records = [record]
+            if name in shared_names:
+                if name in verified_names:
+                    continue
+                verified_names.add(name)
+                records = filenames_map.lookup(name)
+            paths = [record["path"] for record in records
+                     if is_selected(record["path"], include, exclude)]
+            if not paths:
+                continue
+            filename = source + name
+            if not os.path.isfile(filename):
+                for path in paths:
+                    print("Missing: %s (%s)" % (path, name))
+                    missing.append(path)
+                continue
+            min_size = max(record.get("offset", 0) + record.get("length", 0)
+                           for record in records)
+            pending[filename] = paths
+            yield key, filename, min_size
+
+    # Files that are not in the filenames maps can only be found if every
+    # session has one
+    find_extra = True
+    for key, secret_path, map_path in sessions:
+        filenames_map = load_filenames_map(map_path, key)
+        if filenames_map is None:
+            find_extra = False
+            continue
+        with filenames_map:
+            try:
+                run_jobs(verify_file, verification_jobs(key, filenames_map),
+                         jobs, file_verified, on_error=file_corrupted)
+            except ValueError as error:
+                # The records of the filenames map are authenticated too
+                print("Corrupted: %s (%s)" % (map_path, error))
+                corrupted.append((map_path, str(error)))
+                find_extra = False
+
+    extra = []
+    if find_extra:
+        generated_files = {journal.JOURNAL_NAME}
+        generated_files.update(manifest.session_files(
+            source, manifest.find_sessions(source)))
+        for _, secret_path, map_path in sessions:
+            generated_files.update(os.path.basename(path)
+                                   for path in (secret_path, map_path))
+        if incremental.is_index(source + incremental.INDEX_NAME):
+            generated_files.add(incremental.INDEX_NAME)
+        filenames_maps = [load_filenames_map(map_path, key)
+                          for key, _, map_path in sessions]
+        try:
+            for entry in os.scandir(source):
+                if not entry.is_file() or entry.name in generated_files:
+                    continue
+                if not any(entry.name in filenames_map
+                           for filenames_map in filenames_maps):
+                    print("Extra: " + entry.path)
+                    extra.append(entry.path)
+        finally:
+            for filenames_map in filenames_maps:
+                filenames_map.close()
+    return verified, missing, corrupted, extra
+
+
+def skip(infile, length, chunksize=64*1024):
+    """ Reads and throws away data from a file object that cannot seek.
+
+    Arguments:
+        infile          The file object to read from
+        length          The number of bytes to skip
+        chunksize       The size of the chunks to read
+    """
+    chunk = bytearray(chunksize)
+    view = memoryview(chunk)
+    while length:
+        read = infile.readinto(view[:min(length, chunksize)])
+        if not read:
+            raise ValueError("Truncated file")
+        length -= read
+
+
+def export(source, outfile, secret=None, private_key="./key.private",
+           include=None, exclude=None):
+    """ Writes the decrypted files of the source folder as a tar stream.
+
+        Every file is decrypted one segment at a time directly into the
+        archive (see the `streams` module), under its original path from the
+        filenames map, so nothing is written to the disk. The files of a
+        bundle are exported with a single sequential read of it, while
+        identical copies are exported as hard links to the first one. If a
+        file was encrypted in more than one session, the archive contains
+        every version, with the latest one last so it is the one extracted.
+
+        Arguments:
+            source          The folder with the encrypted files
+            outfile         The binary file object to write the tar stream
+                            to, e.g. `sys.stdout.buffer`. It does not have to
+                            be seekable.
+            secret          The (encrypted) secret used for the encryption
+            private_key     The private key to be used for the decryption
+            include         Patterns of the original paths to export, see
+                            `is_selected`. Everything is exported if None.
+            exclude         Patterns of the original paths not to export
+
+        Return:
+            exported        The number of files in the archive
+    """
+    if source[-1] != os.sep:
+        source += os.sep
+    sessions = load_sessions(source, secret, private_key)
+    exported = 0
+    # The modification time of the files is not in the filenames map
+    mtime = int(time.time())
+
+    def file_info(path, size=0):
+        info = tarfile.TarInfo(path.replace(os.sep, "/"))
+        info.size = size
+        info.mode = 0o644
+        info.mtime = mtime
+        return info
+
+    with tarfile.open(fileobj=outfile, mode="w|") as archive:
+        for key, secret_path, map_path in sessions:
+            # Nothing but the archive should be written to the output
+            if not os.path.isfile(map_path):
+                raise ValueError("Cannot export session without the "
+                                 "filenames map: " + secret_path)
+            with load_filenames_map(map_path, key) as filenames_map:
+                shared_names = filenames_map.shared_names()
+                exported_names = set()
+                for record in filenames_map:
+                    name = record["name"]
+                    records = [record]
+                    if name in shared_names:
+                        if name in exported_names:
+                            continue
+                        exported_names.add(name)
+                        records = filenames_map.lookup(name)
+                    selected = [record for record in records
+                                if is_selected(record["path"], include,
+                                               exclude)]
+                    if not selected:
+                        continue
+                    filename = source + name
+                    if not os.path.isfile(filename):
+                        print("Warning: Encrypted file not found: " +
+                              filename, file=sys.stderr)
+                        continue
+                    # Bundles are read in the order their files were packed
+                    selected.sort(key=lambda record: record.get("offset", 0))
+                    with open(filename, "rb") as infile:
+                        reader = streams.DecryptingReader(key, infile)
+                        # Short reads at the end of the segments would end
+                        # the files of the archive early
+                        reader = io.BufferedReader(reader)
+                        position = 0
+                        # The first path of every (offset, length) in the
+                        # encrypted file, which its copies are linked to
+                        first_paths = dict()
+                        for record in selected:
+                            offset = record.get("offset", 0)
+                            length = record.get("length",
+                                                reader.raw.filesize)
+                            first = first_paths.setdefault((offset, length),
+                                                           record["path"])
+                            if first != record["path"]:
+                                info = file_info(record["path"])
+                                info.type = tarfile.LNKTYPE
+                                info.linkname = first.replace(os.sep, "/")
+                                archive.addfile(info)
+                                exported += 1
+                                continue
+                            skip(reader, offset - position)
+                            archive.addfile(file_info(record["path"], length),
+                                            reader)
+                            position = offset + length
+                            exported += 1
+                        if not bundle.is_packed(selected[0]):
+                            # Authenticate the end of the file too
+                            skip(reader, reader.raw.filesize - position)
+                            if reader.read(1):
+                                raise ValueError("Unexpected data: " +
+                                                 filename)
+    return exported
+
+
+def count_files(source, sessions, include=None, exclude=None):
+    """ Counts the encrypted files that will be decrypted.
+
+    Arguments:
+        source          The folder with the encrypted files, ending with a
+                        separator
+        sessions        The sessions to be decrypted, see `load_sessions`
+        include         Patterns of the original paths to decrypt
+        exclude         Patterns of the original paths not to decrypt
+
+    Return:
+        files           The number of encrypted files
+        total_size      The total size of the encrypted files, or of the
+                        clear text of the files packed in bundles
+    """
+    files = 0
+    total_size = 0
+    for key, secret_path, map_path in sessions:
+        if not os.path.isfile(map_path):
+            # Every file of the source folder will be decrypted
+            for dirpath, _, filenames in os.walk(source):
+                for name in filenames:
+                    filename = os.path.join(dirpath, name)
+                    if filename != secret_path:
+                        files += 1
+                        total_size += os.path.getsize(filename)
+            continue
+        with load_filenames_map(map_path, key) as filenames_map:
+            for record in filenames_map:
+                filename = source + record["name"]
+                if (is_selected(record["path"], include, exclude) and
+                        os.path.isfile(filename)):
+                    files += 1
+                    if bundle.is_packed(record):
+                        total_size += record["length"]
+                    else:
+                        total_size += os.path.getsize(filename)
+    return files, total_size
+
+
+def run(source, destination, secret, private_key="./key.private", jobs=1,
+        include=None, exclude=None, on_progress=None, executor=None,
+        sessions=None):
+    """ Decrypts the source folder and outputs to the destination folder.
+
+        Arguments:
+            source          The folder to be decrypted
+            destination     The folder where the decrypted files will end up
+            secret          The (encrypted) secret used for the encryption
+            private_key     The private key to be used for the decryption,
+                            either a path or a cipher already loaded with
+                            `load_private_key`
+            jobs            The number of files to be decrypted in parallel
+            include         Patterns of the original paths to decrypt, see
+                            `is_selected`. Everything is decrypted if None.
+            exclude         Patterns of the original paths not to decrypt
+            on_progress     Function called with the progress of the
+                            decryption, see the `progress` module. The sizes
+                            reported are the ones of the encrypted files.
+            executor        An existing pool of `jobs` worker processes to
+                            decrypt the files with, e.g. one shared between
+                            multiple volumes
+            sessions        The sessions of the source folder, if their
+                            secrets have already been decrypted with
+                            `load_sessions`
+    """
+    # Make sure that the source and destination folders finish with separator
+    if source[-1] != os.sep:
+        source += os.sep
+    if destination[-1] != os.sep:
+        destination += os.sep
+
+    tracker = progress.ProgressTracker(on_progress)
+    # The sizes of the encrypted files that are being decrypted
+    file_sizes = dict()
+
+    def file_done(key, in_filename, out_filename, remove_original,
+                  packed_files=None, copies=()):
+        if not tracker.enabled:
+            return
+        if packed_files:
+            for _, length, _ in packed_files:
+                tracker.file_done(length)
+            return
+        size = file_sizes.pop(in_filename)
+        for _ in range(1 + len(copies)):
+            tracker.file_done(size)
+
+    # Decrypt the AES secrets of all the sessions
+    with tracker.stage("secret"):
+        if sessions is None:
+            sessions = load_sessions(source, secret, private_key)
+    if tracker.enabled:
+        with tracker.stage("scan"):
+            tracker.add_total(*count_files(source, sessions, include,
+                                           exclude))
+    # When only some of the files are decrypted, the rest of them should
+    # still be decryptable afterwards
+    selective = bool(include or exclude)
+
+    # The sessions are decrypted one after the other, so that if a file was
+    # encrypted more than once, its latest version is the one restored
+    for decrypted_aes_secret, secret_path, json_encrypted_map in sessions:
+        # We should restore the file structure, therefore we should parse the
+        # file containing the encrypted structure and create the appropriate
+        # filepaths. To do that we need to restore the mapping that contains
+        # the real to obscured paths combinations.
+        filenames_map = load_filenames_map(json_encrypted_map,
+                                           decrypted_aes_secret)
+        if filenames_map is None and (selective or len(sessions) > 1):
+            raise ValueError("Cannot decrypt session without the filenames "
+                             "map: " + secret_path)
+
+        if filenames_map is None:
+            # If for some reason the filenames map is not defined then decrypt
+            # every file and suffix them to indicate that they are decrypted
+            def decryption_jobs():
+                """ Generates the arguments for every encrypted file found. """
+                # Recursively unencrypt files in the source folder
+                for dirpath, dirnames, filenames in os.walk(source):
+                    for name in filenames:
+                        filename = os.path.join(dirpath, name)
+                        # Do not unencrypt files that we have generated
+                        # ourselves
+                        if filename == secret_path:
+                            continue
+                        if tracker.enabled:
+                            file_sizes[filename] = os.path.getsize(filename)
+                        print("Decrypting: " + filename)
+                        yield (decrypted_aes_secret, filename,
+                               destination + name + ".clear",
+                               source == destination)
+
+            with tracker.stage("decrypt"):
+                run_jobs(decrypt_job, decryption_jobs(), jobs, file_done,
+                         executor)
+            continue
+
+        def decryption_jobs():
+            """ Generates the arguments for every file in the filenames map.
+
+                The folder structure of each file is created once, instead of
+                checking for every single file that is restored.
+            """
+            created_folders = set()
+
+            def restored_path(record):
+                """ Returns the path of the decrypted file of a record. """
+                # Get the real filename and its path
+                destination_file = destination + record["path"]
+                # Create the necessary folder structure
+                folder_structure = os.path.dirname(destination_file)
+                if folder_structure not in created_folders:
                     os.makedirs(folder_structure, exist_ok=True)
-                else:
-                    # If for some reason the filenames map is not defined then
-                    # suffix the files to indicate that they are decrypted
-                    destination_file = destination + name + ".clear"
+                    created_folders.add(folder_structure)
+                return destination_file
+
+            # The bundles and the files with copies have multiple records,
+            # which are all restored along with the first one
+            shared_names = filenames_map.shared_names()
+            restored_names = set()
+            for record in filenames_map:
+                name = record["name"]
+                records = [record]
+                if name in shared_names:
+                    if name in restored_names:
+                        continue
+                    restored_names.add(name)
+                    records = filenames_map.lookup(name)
+                # Only the selected files are read from the source folder
+                selected = [record for record in records
+                            if is_selected(record["path"], include, exclude)]
+                if not selected:
+                    continue
+                filename = source + name
+                if not os.path.isfile(filename):
+                    print("Warning: Encrypted file not found: " + filename)
+                    continue
                 print("Decrypting: " + filename)
-                decrypt_file(decrypted_aes_secret, filename, destination_file)
-            # If we are decrypting in the same folder as the encrypted files
-            # then remove the original encrypted files
-            if source == destination:
+                # If we are decrypting in the same folder as the encrypted
+                # files then remove the original encrypted files, unless some
+                # of their files are not decrypted
+                remove_original = (source == destination and
+                                   len(selected) == len(records))
+                if bundle.is_packed(selected[0]):
+                    packed_files = [(record["offset"], record["length"],
+                                     restored_path(record))
+                                    for record in selected]
+                    yield (decrypted_aes_secret, filename, None,
+                           remove_original, packed_files)
+                    continue
+                if tracker.enabled:
+                    file_sizes[filename] = os.path.getsize(filename)
+                yield (decrypted_aes_secret, filename,
+                       restored_path(selected[0]), remove_original, None,
+                       [restored_path(record) for record in selected[1:]])
+
+        with filenames_map, tracker.stage("decrypt"):
+            run_jobs(decrypt_job, decryption_jobs(), jobs, file_done,
+                     executor)
+
+    # If we are decrypting in the same folder as the encrypted files then
+    # remove the files that we have generated ourselves too
+    if source == destination and not selective:
+        with tracker.stage("cleanup"):
+            generated_files = []
+            # A file of the user with the same name has been restored
+            if incremental.is_index(source + incremental.INDEX_NAME):
+                generated_files.append(source + incremental.INDEX_NAME)
+            for _, secret_path, json_encrypted_map in sessions:
+                generated_files += [secret_path, json_encrypted_map]
+            for filename in generated_files:
                 if os.path.exists(filename):
                     os.remove(filename)
+    tracker.finish()
+
+
+def run_batch(volume_list, private_key="./key.private", jobs=1, include=None,
+              exclude=None):
+    """ Decrypts many volumes, parsing the private key only once.
+
+        The AES secrets of all the volumes are decrypted first, so that
+        volumes with a missing or foreign secret are found before any file
+        is decrypted. The volumes are then decrypted one after the other,
+        sharing a single pool of worker processes. A volume that fails does
+        not stop the rest of them.
+
+        Arguments:
+            volume_list     List of (source, destination) of the volumes, see
+                            the `volumes` module
+            private_key     The private key to be used for the decryption,
+                            either a path or a cipher already loaded with
+                            `load_private_key`
+            jobs            The number of files to be decrypted in parallel
+            include         Patterns of the original paths to decrypt, see
+                            `is_selected`. Everything is decrypted if None.
+            exclude         Patterns of the original paths not to decrypt
+
+        Return:
+            failed          List of (source, error) of the volumes that could
+                            not be decrypted
+    """
+    if isinstance(private_key, str):
+        if not os.path.isfile(private_key):
+            raise FileNotFoundError("Private key not found: " + private_key)
+        private_key = load_private_key(private_key)
+
+    failed = []
+    # Unwrap the secrets of all the volumes before decrypting any of them
+    unwrapped = []
+    for source, destination in volume_list:
+        if source[-1] != os.sep:
+            source += os.sep
+        try:
+            sessions = load_sessions(source, None, private_key)
+        except (OSError, ValueError) as error:
+            print("Failed: %s (%s)" % (source, error))
+            failed.append((source, str(error)))
+            continue
+        unwrapped.append((source, destination, sessions))
+
+    with shared_executor(jobs) as executor:
+        for source, destination, sessions in unwrapped:
+            print("Decrypting volume: " + source)
+            try:
+                os.makedirs(destination, exist_ok=True)
+                run(source, destination, None, private_key, jobs, include,
+                    exclude, executor=executor, sessions=sessions)
+            except (OSError, ValueError) as error:
+                print("Failed: %s (%s)" % (source, error))
+                failed.append((source, str(error)))
+    return failed
+
+
+def parse_range(byte_range):
+    """ Parses a byte range given as OFFSET:LENGTH. """
+    try:
+        offset, length = byte_range.split(":")
+        return int(offset), int(length)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected OFFSET:LENGTH, got: " +
+                                         byte_range)
 
 
 def main():
     parser_description = "Decrypt a directory containing encrypted files"
     parser = argparse.ArgumentParser(description=parser_description)
+    command_message = "`decrypt` (default) restores the files in the \
+    destination folder, `list` prints the original paths of the encrypted \
+    files, `verify` checks that the encrypted files are intact without \
+    decrypting them to the destination folder and reports the missing, \
+    corrupted and extra ones, `export` writes the decrypted files as a tar \
+    archive to --output (or the standard output) without writing them to \
+    the disk."
+    parser.add_argument("command", nargs="?", default="decrypt",
+                        choices=["decrypt", "list", "verify", "export"],
+                        help=command_message)
     parser.add_argument("--source",
-                        help="Path to the directory with the encrypted files",
-                        required=True)
+                        help="Path to the directory with the encrypted files")
     destination_message = "Path to the directory where the unencrypted files \
     will be exported. If it is the same as the source folder, then the \
     existing encrypted files will be removed."
-    parser.add_argument("--destination", help=destination_message,
-                        required=True)
-    secret_help_message = "Path to the (encrypted) AES secret file. If none \
-    provided, a file named `secret` from the source folder will be used."
+    parser.add_argument("--destination", help=destination_message)
+    output_message = "Path to the tar archive written by `export`. If none \
+    provided, the archive is written to the standard output."
+    parser.add_argument("--output", help=output_message)
+    secret_help_message = "Path to the (encrypted) AES secret file, which \
+    selects a single session (e.g. `secret.1` the session 1). If none \
+    provided, the secrets of all the sessions in the source folder will be \
+    used."
     parser.add_argument("--secret", help=secret_help_message)
     parser.add_argument("--private-key", help="Path to the private key",
                         default="./key.private")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of files to decrypt (or verify) in \
+                        parallel")
+    extract_message = "Decrypt only the given file, identified by its \
+    original path or its obscured name, and write it to the standard output \
+    instead of the destination folder. Requires --range."
+    parser.add_argument("--extract", help=extract_message)
+    range_message = "Byte range of the extracted file to decrypt, as \
+    OFFSET:LENGTH. Only the parts of the file that contain the range will be \
+    decrypted."
+    parser.add_argument("--range", type=parse_range, help=range_message)
+    include_message = "Only decrypt (list, verify or export) the files whose \
+    original path matches the pattern. Shell-style wildcards are supported \
+    and a folder matches all the files under it. Can be given multiple \
+    times."
+    parser.add_argument("--include", action="append", help=include_message)
+    exclude_message = "Do not decrypt (list, verify or export) the files \
+    whose original path matches the pattern. Can be given multiple times."
+    parser.add_argument("--exclude", action="append", help=exclude_message)
+    batch_message = "Decrypt many volumes, loading the private key and \
+    starting the --jobs workers only once. The file has a line with the \
+    source and the destination folder of every volume, separated by a tab."
+    parser.add_argument("--batch", help=batch_message)
+    volumes_message = "Decrypt every volume (subfolder with a secret) of the \
+    given folder to a subfolder of --destination with the same name, as with \
+    --batch."
+    parser.add_argument("--volumes", help=volumes_message)
     args = parser.parse_args()
 
-    run(args.source, args.destination, args.secret, args.private_key)
+    try:
+        run_command(parser, args)
+    except (OSError, ValueError) as error:
+        print(error)
+        sys.exit(1)
+
+
+def run_command(parser, args):
+    """ Runs the command given in the command line arguments. """
+    if args.batch or args.volumes:
+        if args.command != "decrypt" or args.source or args.secret:
+            parser.error("--batch and --volumes can only be used to decrypt "
+                         "and without --source or --secret")
+        if args.batch:
+            volume_list = volumes.read_list(args.batch)
+        else:
+            if not args.destination:
+                parser.error("--volumes requires --destination")
+            volume_list = volumes.find(args.volumes, args.destination,
+                                       manifest.find_sessions)
+        failed = run_batch(volume_list, args.private_key, args.jobs,
+                           args.include, args.exclude)
+        print("Decrypted %d volumes, %d failed" %
+              (len(volume_list) - len(failed), len(failed)))
+        if failed:
+            sys.exit(1)
+        return
+    if not args.source:
+        parser.error("the following arguments are required: --source")
+
+    if args.command == "list":
+        for path in list_files(args.source, args.secret, args.private_key,
+                               args.include, args.exclude):
+            print(path)
+        return
+
+    if args.command == "verify":
+        verified, missing, corrupted, extra = verify(
+            args.source, args.secret, args.private_key, args.jobs,
+            args.include, args.exclude)
+        print("Verified: %d intact, %d missing, %d corrupted, %d extra" %
+              (verified, len(missing), len(corrupted), len(extra)))
+        if missing or corrupted or extra:
+            sys.exit(1)
+        return
+
+    if args.command == "export":
+        if args.output:
+            with open(args.output, "wb") as outfile:
+                export(args.source, outfile, args.secret, args.private_key,
+                       args.include, args.exclude)
+        else:
+            export(args.source, sys.stdout.buffer, args.secret,
+                   args.private_key, args.include, args.exclude)
+        return
+
+    if args.extract or args.range:
+        if not (args.extract and args.range):
+            parser.error("--extract and --range must be used together")
+        offset, length = args.range
+        data = extract(args.source, args.extract, offset, length,
+                       args.secret, args.private_key)
+        sys.stdout.buffer.write(data)
+        return
+    if not args.destination:
+        parser.error("the following arguments are required: --destination")
+
+    run(args.source, args.destination, args.secret, args.private_key,
+        args.jobs, args.include, args.exclude)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,146 @@
+"""
+Module to choose how the encrypted files are made durable on the volume.
+
+Waiting until every encrypted file has reached the device is what makes it
+safe to remove the clear text originals, but it is also the slowest part of
+encrypting many small files. There are three modes:
+
+    strict      every encrypted file is fsynced before it is committed (see
+                the `journal` module) and its original is removed
+    batch       the encrypted files are fdatasynced every `batch_size` files,
+                after which they are committed and their originals removed
+                together
+    fast        nothing is synced until the end, while the originals are
+                removed as soon as their files are encrypted. An interrupted
+                encryption may lose files.
+
+At the end, only the filesystem of the encrypted volume is flushed (with
+syncfs on Linux) instead of every filesystem of the device. Will work on both
+Windows and Linux.
+"""
+
+import os
+import ctypes
+import ctypes.util
+
+STRICT = "strict"
+BATCH = "batch"
+FAST = "fast"
+MODES = (STRICT, BATCH, FAST)
+DEFAULT_BATCH_SIZE = 64
+
+
+def sync_file(filename):
+    """ Waits until the data of the file has reached the device.
+
+    Arguments:
+        filename        Path to the file
+    """
+    # Windows can only flush files opened for writing
+    fd = os.open(filename, os.O_RDWR)
+    try:
+        if hasattr(os, "fdatasync"):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_volume(path):
+    """ Waits until the filesystem of the path has reached the device.
+
+    Only that filesystem is flushed where syncfs is available (Linux),
+    otherwise every filesystem is.
+
+    Arguments:
+        path            Path to a file or folder on the volume
+    """
+    syncfs = None
+    if os.name == "posix":
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        syncfs = getattr(libc, "syncfs", None)
+    if syncfs is None:
+        if hasattr(os, "sync"):
+            os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if syncfs(fd) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+    finally:
+        os.close(fd)
+
+
+class CommitBatcher():
+    def __init__(self, folder, filenames_map, session_journal=None,
+                 mode=STRICT, batch_size=DEFAULT_BATCH_SIZE):
+        """ Commits the encrypted files as they become durable.
+
+        Arguments:
+            folder          The folder with the encrypted files, ending with
+                            a separator
+            filenames_map   The manifest the files are recorded in, see the
+                            `manifest` module
+            session_journal The Journal of the session or None
+            mode            One of `MODES`
+            batch_size      The number of files synced together in the batch
+                            mode
+        """
+        if mode not in MODES:
+            raise ValueError("Unknown durability mode: " + mode)
+        self.folder = folder
+        self.filenames_map = filenames_map
+        self.session_journal = session_journal
+        self.mode = mode
+        self.batch_size = batch_size
+        # The (obscured name, journal records, callback) of the files that
+        # have not been committed yet
+        self.pending = []
+
+    def is_strict(self):
+        """ Checks whether every file should be fsynced once written. """
+        return self.mode == STRICT
+
+    def commit(self, name, records, on_durable=None):
+        """ Commits an encrypted file, once it is durable in the batch mode.
+
+        Arguments:
+            name            The obscured name of the encrypted file, which
+                            should already be synced in the strict mode
+            records         List of (position of the record in the manifest,
+                            original path) of the files in it, see
+                            `Journal.commit`
+            on_durable      Function called once the file is committed, e.g.
+                            to remove its original
+        """
+        if self.mode == BATCH:
+            self.pending.append((name, records, on_durable))
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+            return
+        self.filenames_map.flush(durable=self.mode == STRICT)
+        if self.session_journal:
+            self.session_journal.commit(name, records,
+                                        sync=self.mode == STRICT)
+        if on_durable:
+            on_durable()
+
+    def flush(self):
+        """ Syncs and commits the pending files of the batch mode. """
+        if not self.pending:
+            return
+        # Files with copies may be committed more than once
+        for name in {name for name, _, _ in self.pending}:
+            sync_file(self.folder + name)
+        self.filenames_map.flush(durable=True)
+        if self.session_journal:
+            for name, records, _ in self.pending:
+                self.session_journal.commit(name, records, sync=False)
+            self.session_journal.sync()
+        pending = self.pending
+        self.pending = []
+        for _, _, on_durable in pending:
+            if on_durable:
+                on_durable()
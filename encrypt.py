@@ -9,22 +9,38 @@ on both Windows and Linux.
 
 import sys
 import os
-import struct
 import argparse
 import hashlib
 import json
-import tempfile
-import shutil
-from Crypto.Cipher import AES
+import itertools
+import collections
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
+from parallel import run_jobs, shared_executor
+import pipeline
+import compression
+import bundle
+import container
+import manifest
+import journal
+import incremental
+import progress
+import walker
+import streams
+import durability
+import volumes
 
 
-def encrypt_file(key, in_filename, out_filename=None, chunksize=64*1024):
-    """ Encrypts a file using AES (CBC mode) with the
-        given key.
+def encrypt_file(key, in_filename, out_filename=None, chunksize=64*1024,
+                 legacy=False, compress=False):
+    """ Encrypts a file using AES with the given key.
 
-        Adopted from Eli Bendersky's example:
+        Unless the legacy format is requested, the file is split in segments
+        of `chunksize` bytes which are encrypted independently in GCM mode,
+        so that they can be decrypted and authenticated in any order. See the
+        `container` module for the layout of the encrypted file.
+
+        The legacy format is adopted from Eli Bendersky's example:
         http://eli.thegreenplace.net/2010/06/25/aes-encryption-of-files-in-python-with-pycrypto/
 
         Arguments:
@@ -40,27 +56,114 @@ def encrypt_file(key, in_filename, out_filename=None, chunksize=64*1024):
                             uses to read and encrypt the file. Larger chunk
                             sizes can be faster for some files and machines.
                             chunksize must be divisible by 16.
+                            Reading, encrypting and writing of the chunks
+                            are pipelined, see the `pipeline` module.
+            legacy          Whether to encrypt the whole file as a single
+                            AES-CBC stream, which is the format of the
+                            previous versions.
+            compress        Whether to compress the file before encrypting
+                            it, unless it looks already compressed. See the
+                            `compression` module. Ignored for the legacy
+                            format.
     """
     if not out_filename:
         out_filename = os.path.basename(in_filename) + '.enc'
 
-    iv = os.urandom(16)
-    encryptor = AES.new(key, AES.MODE_CBC, iv)
+    if legacy:
+        encrypt_legacy_file(key, in_filename, out_filename, chunksize)
+        return
+
+    filesize = os.path.getsize(in_filename)
+    flags = 0
+    if compress and compression.is_compressible(in_filename):
+        flags |= container.FLAG_COMPRESSED
+    with open(in_filename, 'rb') as infile:
+        encrypt_stream(key, infile, out_filename, filesize, chunksize, flags)
+
+
+def encrypt_bundle(key, files, out_filename, chunksize=64*1024,
+                   compress=False):
+    """ Encrypts multiple small files as a single one, see the `bundle`
+        module.
+
+        Arguments:
+            key             The encryption key
+            files           List of (path, size) of the files to be packed
+            out_filename    Path to the encrypted bundle to be generated
+            chunksize       The size of the segments, must be divisible by 16
+            compress        Whether to compress the bundle before encrypting
+                            it, unless its files look already compressed
+    """
+    filesize = sum(size for _, size in files)
+    flags = 0
+    if compress and compression.are_compressible(files):
+        flags = container.FLAG_COMPRESSED
+    with bundle.BundleReader(files) as infile:
+        encrypt_stream(key, infile, out_filename, filesize, chunksize, flags)
+
+
+def encrypt_stream(key, infile, out_filename, filesize, chunksize=64*1024,
+                   flags=0):
+    """ Encrypts the contents of a file object in segments.
+
+        Arguments:
+            key             The encryption key
+            infile          The file object to read the clear text from
+            out_filename    Path to the encrypted file to be generated
+            filesize        The size of the clear text
+            chunksize       The size of the segments, must be divisible by 16
+            flags           The flags of the container header. The clear
+                            text is compressed if FLAG_COMPRESSED is set.
+    """
+    header = container.new_header(filesize, chunksize, flags)
+    indices = itertools.count()
+
+    def encrypt_segment(segment, length):
+        return container.encrypt_segment(key, header, next(indices), segment,
+                                         length)
+
+    if flags & container.FLAG_COMPRESSED:
+        # Compress in the reading stage of the pipeline
+        infile = compression.CompressingReader(infile)
+    with open(out_filename, 'wb') as outfile:
+        outfile.write(header.raw)
+        pipeline.run(infile, outfile, encrypt_segment, chunksize,
+                     reserve=container.TAG_SIZE)
+
+
+def encrypt_legacy_file(key, in_filename, out_filename, chunksize=64*1024):
+    """ Encrypts a file as a single AES-CBC stream.
+
+        Arguments:
+            key             The encryption key
+            in_filename     Path to the file to be encrypted
+            out_filename    Path to the encrypted file to be generated
+            chunksize       The size of the chunks, must be divisible by 16
+    """
     filesize = os.path.getsize(in_filename)
 
     with open(in_filename, 'rb') as infile:
         with open(out_filename, 'wb') as outfile:
-            outfile.write(struct.pack('<Q', filesize))
-            outfile.write(iv)
+            with streams.EncryptingWriter(key, outfile, filesize, chunksize,
+                                          legacy=True) as writer:
+                # Encrypt in the writing stage of the pipeline
+                pipeline.run(infile, writer, lambda chunk, length: length,
+                             chunksize)
 
-            while True:
-                chunk = infile.read(chunksize)
-                if len(chunk) == 0:
-                    break
-                elif len(chunk) % 16 != 0:
-                    chunk += ' '.encode("UTF-8") * (16 - len(chunk) % 16)
 
-                outfile.write(encryptor.encrypt(chunk))
+def load_public_key(public_key_file):
+    """ Reads and parses the public key, so it can be reused.
+
+        Arguments:
+            public_key_file     Path to the public key
+
+        Return:
+            cipher              The RSA (PKCS#1 OAEP) cipher of the public key
+    """
+    with open(public_key_file, 'r') as pub_file:
+        pub_key = RSA.importKey(pub_file.read())
+
+    return PKCS1_OAEP.new(pub_key)
 
 
 def encrypt_string(text_to_encrypt, public_key_file):
@@ -68,27 +171,160 @@ def encrypt_string(text_to_encrypt, public_key_file):
 
         Arguments:
             text_to_encrypt     The plain text to encrypt
-            public_key_file     The public key to be used for encryption
+            public_key_file     The public key to be used for encryption,
+                                either a path or a cipher already loaded with
+                                `load_public_key`
 
         Return:
             encrypted_text      The encrypted text using the public key
     """
-
-    with open(public_key_file, 'r') as pub_file:
-        pub_key = RSA.importKey(pub_file.read())
-
-    cipher = PKCS1_OAEP.new(pub_key)
+    if isinstance(public_key_file, str):
+        cipher = load_public_key(public_key_file)
+    else:
+        cipher = public_key_file
     encrypted_text = cipher.encrypt(text_to_encrypt)
     return encrypted_text
 
 
-def run(source, destination, public_key="./key.public"):
+class LegacyManifestWriter():
+    def __init__(self, filename, key):
+        """ Collects the map between the real and obscured filepaths in memory
+        and saves it as an encrypted JSON file, which is the format of the
+        previous versions, when closed.
+
+        Arguments:
+            filename    Path to the encrypted map
+            key         The AES secret to encrypt the map with
+        """
+        self.filename = filename
+        self.key = key
+        self.filenames_map = dict()
+
+    def add(self, name, path, **attributes):
+        self.filenames_map[name] = path
+
+    def __len__(self):
+        return len(self.filenames_map)
+
+    def flush(self, durable=False):
+        pass
+
+    def close(self):
+        # Save and encrypt the mapping between real and obscured filepaths
+        data = json.dumps(self.filenames_map).encode("UTF-8")
+        with open(self.filename, "wb") as map_file:
+            with streams.EncryptingWriter(self.key, map_file, len(data),
+                                          legacy=True) as writer:
+                writer.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def hash_file(filename, chunksize=1024*1024):
+    """ Hashes the contents of a file to find identical ones.
+
+        Arguments:
+            filename        Path to the file
+            chunksize       The size of the chunks to read the file in
+
+        Return:
+            digest          The BLAKE2b digest of the contents
+    """
+    content_hash = hashlib.blake2b(digest_size=32)
+    chunk = bytearray(chunksize)
+    view = memoryview(chunk)
+    with open(filename, 'rb') as infile:
+        while True:
+            length = infile.readinto(chunk)
+            if not length:
+                break
+            content_hash.update(view[:length])
+    return content_hash.digest()
+
+
+def encrypt_job(key, in_filename, out_filename, legacy=False, durable=False,
+                compress=False, packed_files=None):
+    """ Encrypts a single file or a bundle of small files.
+
+        Module level so that it can be dispatched to worker processes.
+
+        Arguments:
+            key             The AES secret to encrypt the file with
+            in_filename     Path to the file to be encrypted, None for bundles
+            out_filename    Path to the encrypted file to be generated
+            legacy          Whether to use the legacy encrypted file format
+            durable         Whether to wait until the encrypted file has
+                            reached the device
+            compress        Whether to compress the file if it is worth it
+            packed_files    List of (path, size) of the files to be packed in
+                            a bundle instead of a single file
+    """
+    if packed_files:
+        encrypt_bundle(key, packed_files, out_filename, compress=compress)
+    else:
+        encrypt_file(key, in_filename, out_filename, legacy=legacy,
+                     compress=compress)
+    if durable:
+        with open(out_filename, "rb+") as outfile:
+            os.fsync(outfile.fileno())
+
+
+def run(source, destination, public_key="./key.public", jobs=1,
+        legacy=False, incremental_index=False, executor=None,
+        on_progress=None, compress=False, pack=False, dedup=False,
+        durability_mode=durability.STRICT,
+        sync_every=durability.DEFAULT_BATCH_SIZE):
     """ Encrypts the source folder and outputs to the destination folder.
 
+        Every run creates a new session (see the `manifest` module) in the
+        destination folder, with its own secret and filenames map. The
+        progress is recorded in a journal (see the `journal` module), so that
+        an interrupted run can be continued without encrypting the completed
+        files again. Encrypted files of previous sessions are never
+        re-encrypted.
+
         Arguments:
             source          The folder to be encrypted
             destination     The folder where the encrypted files will end up
-            public_key      The public key to be used for the encryption
+            public_key      The public key to be used for the encryption,
+                            either a path or a cipher already loaded with
+                            `load_public_key`
+            jobs            The number of files to be encrypted in parallel
+            legacy          Whether to use the legacy encrypted file format,
+                            which can be read by older versions of `decrypt`.
+                            Interrupted runs cannot be continued in this case.
+            incremental_index   Whether to skip the files that have not
+                            changed since they were last encrypted to the
+                            destination, see the `incremental` module
+            executor        An existing pool of `jobs` worker processes to
+                            encrypt the files with, e.g. one shared between
+                            multiple volumes
+            on_progress     Function called with the progress of the
+                            encryption, see the `progress` module. The files
+                            to be encrypted are counted as the source folder
+                            is walked, so the time left is only estimated
+                            once all of them have been found.
+            compress        Whether to compress the files before encrypting
+                            them, see the `compression` module
+            pack            Whether to pack the small files into bundles, see
+                            the `bundle` module. Ignored for the legacy
+                            format.
+            dedup           Whether to encrypt files with identical contents
+                            only once. Files of the same size are hashed and
+                            the records of the copies in the filenames map
+                            point to the encrypted file of the first one.
+                            Ignored for the legacy format.
+            durability_mode How the encrypted files are made durable before
+                            they are committed and, when encrypting in place,
+                            their originals are removed. One of the modes of
+                            the `durability` module. Only the destination
+                            volume is flushed at the end.
+            sync_every      The number of files synced together in the batch
+                            durability mode
     """
     # Make sure that the source and destination folders finish with separator
     if source[-1] != os.sep:
@@ -97,78 +333,390 @@ def run(source, destination, public_key="./key.public"):
         destination += os.sep
 
     # Check to see if there is actually a public key file
-    if not os.path.isfile(public_key):
-        print("Public key not found: " + public_key)
-        sys.exit(1)
+    if isinstance(public_key, str) and not os.path.isfile(public_key):
+        raise FileNotFoundError("Public key not found: " + public_key)
+
+    tracker = progress.ProgressTracker(on_progress)
+    # The legacy filenames map cannot describe bundles or copies
+    pack = pack and not legacy
+    dedup = dedup and not legacy
+
+    # Continue from where an interrupted run stopped
+    resumed = journal.recover(destination)
+    if resumed is not None:
+        print("Continuing interrupted encryption: " + destination)
+    # The files encrypted before an interruption, if they are still there
+    salt, finished = resumed if resumed else (None, set())
+
+    # Files of the user named like the secret or the manifest are neither
+    # taken for a session nor overwritten by the new one
+    sessions = manifest.find_sessions(destination)
+    session = manifest.new_session(destination, sessions)
+    secret_path, json_map_path = manifest.session_paths(destination, session)
+    session_files = manifest.session_files(destination, sessions + [session])
+
+    # Sizes and modification times of the files that are being encrypted,
+    # opened before anything is written in case it cannot be used
+    file_index = incremental.FileIndex(destination) if incremental_index \
+        else None
+
+    # Started before the secret is saved, so that an interrupted encryption
+    # removes it if no file has been committed
+    session_journal = None if legacy else \
+        journal.Journal(destination, session, salt, finished)
 
     # Generate a random secret that will encrypt the files as AES-256
     aes_secret = os.urandom(32)
 
     # Encrypt and save our AES secret using the public key for the holder of
     # the private key to be able to decrypt the files.
-    secret_path = destination + "secret"
-    with open(secret_path, "wb") as key_file:
+    with tracker.stage("secret"), open(secret_path, "wb") as key_file:
         key_file.write(encrypt_string(aes_secret, public_key))
+        key_file.flush()
+        os.fsync(key_file.fileno())
+
+    # Save and encrypt the mapping between real and obscured filepaths as the
+    # files are being encrypted
+    if legacy:
+        filenames_map = LegacyManifestWriter(json_map_path, aes_secret)
+    else:
+        filenames_map = manifest.ManifestWriter(json_map_path, aes_secret)
+    # Commits the encrypted files once they are durable
+    committer = durability.CommitBatcher(destination, filenames_map,
+                                         session_journal, durability_mode,
+                                         sync_every)
+    file_stats = dict()
+
+    def is_output(dirpath, name):
+        """ Checks whether a file in the source folder has been generated by
+            this or a previous encryption. """
+        if dirpath + os.sep != destination and dirpath != destination:
+            return False
+        return (name in session_files or
+                name == journal.JOURNAL_NAME or
+                (name == incremental.INDEX_NAME and
+                 incremental.is_index(dirpath + os.sep + name)) or
+                (sessions and manifest.is_obscured_name(name)))
 
-    # Recursively encrypt all files and filenames in source folder
-    filenames_map = dict()  # Will contain the real - obscured paths combos
-    for dirpath, dirnames, filenames in os.walk(source):
-        for name in filenames:
-            filename = os.path.join(dirpath, name)
-            # In case source is the same as destination, the encrypted secret
-            # will be one of the detected files and should not be re-encrypted
-            if filename == secret_path:
+    source_tree = walker.TreeWalker(source)
+
+    def source_files():
+        """ Generates the path, the real path and, if needed, the stat of
+            every file that should be encrypted. """
+        # Recursively encrypt all files and filenames in source folder
+        for entry, real_filepath in source_tree:
+            # In case source is the same as destination, the encrypted
+            # secret and map will be among the detected files and should
+            # not be re-encrypted
+            if is_output(os.path.dirname(entry.path), entry.name):
+                continue
+            stat = None
+            if file_index or tracker.enabled or pack or dedup:
+                # Cached by the entry, following symbolic links like open()
+                stat = entry.stat()
+            # Skip the files that have not changed since the last time
+            if file_index and file_index.is_unchanged(real_filepath, stat):
+                continue
+            if finished and session_journal and \
+                    session_journal.path_hash(real_filepath) in finished:
                 continue
-            # Save the real filepath
-            real_filepath = filename.replace(source, "")
-            # Generate a salted file path
-            salted_path = (str(os.urandom(16)) + real_filepath).encode("UTF-8")
-            # Create a unique obscured filepath by hashing the salted filpath
-            unique_name = hashlib.sha512(salted_path).hexdigest()
-            # Save it to the filenames map along with the original filepath
-            filenames_map[unique_name] = real_filepath
-            # Encrypt the clear text file and give it an obscured name
+            yield entry.path, real_filepath, stat
+
+    def obscured_name():
+        """ Generates a unique name that does not reveal the real one. """
+        # As long as a SHA-512 hex digest, like the names of older versions
+        return os.urandom(64).hex()
+
+    def encryption_jobs(files):
+        """ Generates the arguments for every file that should be encrypted.
+
+            The obscured names are generated here, in the calling process, so
+            that there is a single filenames map regardless of the number of
+            workers that will do the actual encryption. Small files are
+            gathered in bundles if they should be packed.
+        """
+        packed_files = []
+        packed_size = 0
+        for filename, _, stat in files:
+            if stat:
+                file_stats[filename] = stat
+            if dedup and stat.st_size in duplicate_sizes:
+                content = (stat.st_size, hash_file(filename))
+                original = originals.setdefault(content, filename)
+                if original != filename:
+                    print("Deduplicating: " + filename)
+                    if blobs[original]:
+                        # The first copy has already been encrypted
+                        commit_files(blobs[original][0],
+                                     [(filename, blobs[original][1])])
+                    else:
+                        copies.setdefault(original, []).append(filename)
+                    continue
+                blobs[filename] = None
             print("Encrypting: " + filename)
-            encrypt_file(aes_secret, filename, destination + unique_name)
-            # If we are encrypting in the same folder as the clear text files
-            # then remove the original unencrypted files
-            if source == destination:
-                if os.path.exists(filename):
-                    os.remove(filename)
-
-    # If the source folder is the same as the destination, we should have some
-    # leftover empty subdirectories. Let's remove those too.
-    if source == destination:
-        for content in os.listdir(source):
-            content_path = os.path.join(source, content)
-            if os.path.isdir(content_path):
-                shutil.rmtree(content_path)
-
-    # Save and encrypt the mapping between real and obscured filepaths
-    json_map_name = "filenames_map"
-    with tempfile.NamedTemporaryFile(mode="r+t") as tmp_json:
-        tmp_json.write(json.dumps(filenames_map))
-        tmp_json.seek(0)  # Set the position to the beginning so we can read
-        # Encrypt the cleartext json file
-        encrypt_file(aes_secret, tmp_json.name, destination + json_map_name)
+            if pack and stat.st_size <= bundle.MAX_PACKED_SIZE:
+                packed_files.append((filename, stat.st_size))
+                packed_size += stat.st_size
+                if (packed_size >= bundle.BUNDLE_SIZE or
+                        len(packed_files) >= bundle.BUNDLE_FILES):
+                    yield (aes_secret, None, destination + obscured_name(),
+                           legacy, committer.is_strict(), compress,
+                           packed_files)
+                    packed_files = []
+                    packed_size = 0
+                continue
+            # Encrypt the clear text file and give it an obscured name.
+            yield (aes_secret, filename, destination + obscured_name(),
+                   legacy, committer.is_strict(), compress, None)
+        if packed_files:
+            yield (aes_secret, None, destination + obscured_name(), legacy,
+                   committer.is_strict(), compress, packed_files)
+
+    def commit(key, filename, out_filename, legacy, durable, compress,
+               packed_files):
+        """ Saves the encrypted file to the filenames map and the journal. """
+        # Save every file along with its position, if it is in a bundle
+        committed = []
+        if packed_files:
+            offset = 0
+            for packed_filename, size in packed_files:
+                committed.append((packed_filename, {"offset": offset,
+                                                    "length": size}))
+                offset += size
+        else:
+            committed.append((filename, {}))
+        commit_files(os.path.basename(out_filename), committed)
+
+    def commit_files(unique_name, committed):
+        """ Saves encrypted files to the filenames map and the journal.
+
+            Arguments:
+                unique_name The obscured name of the encrypted file
+                committed   List of (path, additional record attributes) of
+                            the files that are in the encrypted file
+        """
+        # Save them to the filenames map along with the original filepaths
+        records = [(filenames_map.add(unique_name,
+                                      committed_filename[len(source):],
+                                      **attributes),
+                    committed_filename[len(source):])
+                   for committed_filename, attributes in committed]
+        stats = [file_stats.pop(committed_filename, None)
+                 for committed_filename, _ in committed]
+
+        def on_durable():
+            for (committed_filename, _), stat in zip(committed, stats):
+                if file_index:
+                    file_index.add(committed_filename[len(source):], stat)
+                # If we are encrypting in the same folder as the clear text
+                # files then remove the original unencrypted files, but only
+                # after the encrypted ones have been committed
+                if source == destination:
+                    if os.path.exists(committed_filename):
+                        os.remove(committed_filename)
+
+        committer.commit(unique_name, records, on_durable)
+        for (committed_filename, attributes), stat in zip(committed, stats):
+            if tracker.enabled:
+                tracker.file_done(stat.st_size)
+            # The copies can now point to the encrypted file
+            if committed_filename in blobs:
+                blobs[committed_filename] = (unique_name, attributes)
+                waiting = copies.pop(committed_filename, [])
+                if waiting:
+                    commit_files(unique_name, [(copy, attributes)
+                                               for copy in waiting])
+
+    # The files that may have copies mapped to the (obscured name, record
+    # attributes) of their encrypted file, once it has been committed
+    blobs = dict()
+    # The first file with each (size, hash) of contents
+    originals = dict()
+    # The copies of the files that have not been committed yet
+    copies = dict()
+
+    def counted(files):
+        """ Adds the files to the totals of the progress as they are found.
+        """
+        tracker.counting = True
+        for path, real_filepath, stat in files:
+            tracker.add_total(1, stat.st_size)
+            yield path, real_filepath, stat
+        tracker.counting = False
+
+    files = source_files()
+    if dedup:
+        with tracker.stage("scan"):
+            files = list(files)
+            tracker.add_total(len(files),
+                              sum(stat.st_size for _, _, stat in files))
+            # Balance the load of the workers
+            if jobs > 1:
+                files = walker.largest_first(files)
+    elif tracker.enabled:
+        # Keep streaming the files, instead of holding all of them in memory
+        files = counted(files)
+    # Only the files of the same size need to be hashed
+    if dedup:
+        sizes = collections.Counter(stat.st_size for _, _, stat in files)
+        duplicate_sizes = {size for size, count in sizes.items() if count > 1}
+
+    with filenames_map, tracker.stage("encrypt"):
+        run_jobs(encrypt_job, encryption_jobs(files), jobs, commit, executor)
+        committer.flush()
+
+    with tracker.stage("cleanup"):
+        # Do not leave behind empty sessions, e.g. when an already encrypted
+        # volume is encrypted again
+        if not len(filenames_map):
+            for path in (secret_path, json_map_path):
+                os.remove(path)
+        if session_journal:
+            session_journal.close()
+        if file_index:
+            file_index.close()
+
+        # If the source folder is the same as the destination, we should have
+        # some leftover empty subdirectories. Let's remove those too.
+        if source == destination:
+            source_tree.remove_empty_directories()
+        # Flush only the destination volume, instead of every filesystem
+        durability.sync_volume(destination)
+    tracker.finish()
+
+
+def run_batch(volume_list, public_key="./key.public", jobs=1, **options):
+    """ Encrypts many volumes, parsing the public key only once.
+
+        The volumes are encrypted one after the other, sharing a single pool
+        of worker processes. A volume that fails does not stop the rest of
+        them.
+
+        Arguments:
+            volume_list     List of (source, destination) of the volumes, see
+                            the `volumes` module
+            public_key      The public key to be used for the encryption,
+                            either a path or a cipher already loaded with
+                            `load_public_key`
+            jobs            The number of files to be encrypted in parallel
+            options         Any other arguments of `run`
+
+        Return:
+            failed          List of (source, error) of the volumes that could
+                            not be encrypted
+    """
+    if isinstance(public_key, str):
+        if not os.path.isfile(public_key):
+            raise FileNotFoundError("Public key not found: " + public_key)
+        public_key = load_public_key(public_key)
+
+    failed = []
+    with shared_executor(jobs) as executor:
+        for source, destination in volume_list:
+            print("Encrypting volume: " + source)
+            try:
+                os.makedirs(destination, exist_ok=True)
+                run(source, destination, public_key, jobs, executor=executor,
+                    **options)
+            except (OSError, ValueError) as error:
+                print("Failed: %s (%s)" % (source, error))
+                failed.append((source, str(error)))
+    return failed
 
 
 def main():
     parser_description = "Encrypt a directory"
     parser = argparse.ArgumentParser(description=parser_description)
     parser.add_argument("--source",
-                        help="Path to the directory with the files to encrypt",
-                        required=True)
+                        help="Path to the directory with the files to encrypt")
     destination_message = "Path to the directory where the encrypted files \
     will be exported. If it is the same as the source folder, then the \
     existing unencrypted files will be removed."
-    parser.add_argument("--destination", help=destination_message,
-                        required=True)
+    parser.add_argument("--destination", help=destination_message)
     parser.add_argument("--public-key",
                         help="Path to the public key", default="./key.public")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of files to encrypt in parallel")
+    legacy_message = "Encrypt the files as a single AES-CBC stream, which \
+    can be decrypted by older versions but does not support random access \
+    and authentication."
+    parser.add_argument("--legacy-format", action="store_true",
+                        help=legacy_message)
+    incremental_message = "Only encrypt the files that are new or have \
+    changed (by size and modification time) since the last time the source \
+    was encrypted to the destination. The encrypted files are added to the \
+    existing ones in the destination."
+    parser.add_argument("--incremental", action="store_true",
+                        help=incremental_message)
+    compress_message = "Compress the files before encrypting them, so that \
+    fewer bytes are written. Files that are already compressed (e.g. JPEG, \
+    ZIP or video) are detected and left as they are."
+    parser.add_argument("--compress", action="store_true",
+                        help=compress_message)
+    dedup_message = "Encrypt files with identical contents only once. The \
+    copies are restored when decrypting."
+    parser.add_argument("--dedup", action="store_true", help=dedup_message)
+    pack_message = "Pack the small files into larger encrypted bundles, \
+    which is much faster on drives with slow metadata operations (e.g. FAT32 \
+    or exFAT)."
+    parser.add_argument("--pack-small-files", action="store_true",
+                        help=pack_message)
+    durability_message = "How the encrypted files are made durable before \
+    the originals are removed: `strict` (default) fsyncs every file, `batch` \
+    fdatasyncs them every --sync-every files and `fast` only flushes the \
+    destination volume at the end, which may lose files if the encryption \
+    is interrupted."
+    parser.add_argument("--durability", choices=durability.MODES,
+                        default=durability.STRICT, help=durability_message)
+    parser.add_argument("--sync-every", type=int,
+                        default=durability.DEFAULT_BATCH_SIZE,
+                        help="Number of files synced together with \
+                        --durability=batch")
+    batch_message = "Encrypt many volumes, loading the public key and \
+    starting the --jobs workers only once. The file has a line with the \
+    source and the destination folder of every volume, separated by a tab."
+    parser.add_argument("--batch", help=batch_message)
+    volumes_message = "Encrypt every subfolder of the given folder to a \
+    subfolder of --destination with the same name, as with --batch."
+    parser.add_argument("--volumes", help=volumes_message)
     args = parser.parse_args()
 
-    run(args.source, args.destination, args.public_key)
+    if args.legacy_format and (args.compress or args.pack_small_files or
+                               args.dedup):
+        parser.error("--compress, --pack-small-files and --dedup cannot be "
+                     "used with --legacy-format")
+
+    options = dict(legacy=args.legacy_format,
+                   incremental_index=args.incremental, compress=args.compress,
+                   pack=args.pack_small_files, dedup=args.dedup,
+                   durability_mode=args.durability,
+                   sync_every=args.sync_every)
+    try:
+        if args.batch or args.volumes:
+            if args.source:
+                parser.error("--batch and --volumes cannot be used with "
+                             "--source")
+            if args.batch:
+                volume_list = volumes.read_list(args.batch)
+            else:
+                if not args.destination:
+                    parser.error("--volumes requires --destination")
+                volume_list = volumes.find(args.volumes, args.destination)
+            failed = run_batch(volume_list, args.public_key, args.jobs,
+                               **options)
+            print("Encrypted %d volumes, %d failed" %
+                  (len(volume_list) - len(failed), len(failed)))
+            if failed:
+                sys.exit(1)
+            return
+        if not (args.source and args.destination):
+            parser.error("the following arguments are required: --source, "
+                         "--destination")
+        run(args.source, args.destination, args.public_key, args.jobs,
+            **options)
+    except (OSError, ValueError) as error:
+        print(error)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,109 @@
+"""
+Module to keep track of which clear text files have already been encrypted.
+
+When a folder is repeatedly encrypted to the same destination, only the files
+that are new or have changed since the previous runs need to be encrypted.
+The `index` file in the destination folder records the size and modification
+time of every encrypted file. The original paths are not stored, only their
+SHA-512 hashes salted with a random value of the destination, so the index
+does not reveal the file structure. It is however possible to confirm whether
+a guessed path has been encrypted, which is why this is an opt-in mode.
+
+The index is appended to as files are being encrypted, so that it stays in
+line with the journal (see the `journal` module) if the encryption is
+interrupted. The latest entry of a path is the valid one. The index starts
+with its salt, which tells it apart from a file of the user that happens to be
+named `index`. Will work on both Windows and Linux.
+"""
+
+import os
+import re
+import hashlib
+
+INDEX_NAME = "index"
+SALT_LINE = re.compile(r"^salt [0-9a-f]{32}$")
+
+
+def is_index(path):
+    """ Checks whether the file is an index, rather than a file of the user
+        with the same name. """
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as index_file:
+        first_line = index_file.readline(64).rstrip(b"\n")
+    return SALT_LINE.match(first_line.decode("ascii", "replace")) is not None
+
+
+class FileIndex():
+    def __init__(self, folder):
+        """ Opens the index of the folder, creating it if necessary.
+
+        Arguments:
+            folder      The folder with the encrypted files, ending with a
+                        separator
+        """
+        self.path = folder + INDEX_NAME
+        self.entries = dict()
+        self.salt = None
+        # An empty file is left behind if the index was interrupted before
+        # its salt was written
+        if os.path.isfile(self.path) and os.path.getsize(self.path):
+            if not is_index(self.path):
+                raise ValueError("Cannot keep the index, a file with the same "
+                                 "name exists: " + self.path)
+            with open(self.path, "r") as index_file:
+                # The last line is either empty or partially written
+                lines = index_file.read().split("\n")[:-1]
+            self.salt = bytes.fromhex(lines[0].split()[1])
+            for line in lines[1:]:
+                path_hash, size, mtime = line.split()
+                self.entries[path_hash] = (int(size), int(mtime))
+        self.file = open(self.path, "a")
+        if self.salt is None:
+            self.salt = os.urandom(16)
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.write("salt %s\n" % self.salt.hex())
+            self.file.flush()
+
+    def path_hash(self, real_filepath):
+        """ Returns the salted hash of a path. """
+        salted_path = self.salt + real_filepath.encode("UTF-8")
+        return hashlib.sha512(salted_path).hexdigest()
+
+    def is_unchanged(self, real_filepath, stat):
+        """ Checks whether a file has been encrypted since it last changed.
+
+        Arguments:
+            real_filepath   The path of the file relative to the source folder
+            stat            The result of os.stat() for the file
+
+        Return:
+            True if the file has been encrypted with the same size and
+            modification time, False otherwise
+        """
+        entry = self.entries.get(self.path_hash(real_filepath))
+        return entry == (stat.st_size, stat.st_mtime_ns)
+
+    def add(self, real_filepath, stat):
+        """ Records that a file has been encrypted.
+
+        Arguments:
+            real_filepath   The path of the file relative to the source folder
+            stat            The result of os.stat() for the file, taken before
+                            it was encrypted
+        """
+        path_hash = self.path_hash(real_filepath)
+        self.entries[path_hash] = (stat.st_size, stat.st_mtime_ns)
+        self.file.write("%s %d %d\n" % (path_hash, stat.st_size,
+                                        stat.st_mtime_ns))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,247 @@
+"""
+Module to keep track of the progress of an encryption on the volume itself.
+
+While a volume is being encrypted, a `.cryptopuck-journal` file records the
+session that is being written and every file whose encryption has been
+committed, i.e. its encrypted file and its record in the manifest have reached
+the volume. The journal contains the obscured names and the positions of the
+records, which are anyway visible on the volume, and a salted hash of the path
+of every committed file, like the index of the `incremental` module, so it
+does not need to be encrypted.
+
+If the encryption is interrupted (e.g. the volume is removed or the power
+drops) the next run will use the journal to close the unfinished manifest and
+remove any partially encrypted files, before continuing with the files that
+have not been encrypted yet in a new session. When the source is not the
+destination, the files that have been encrypted are still there and are
+skipped thanks to the hashes of their paths, which are carried over to the
+journal of the new session in case it is interrupted too. The AES secret of
+the interrupted session cannot be reused, since only its encrypted form is
+stored.
+
+The journal starts with a magic line, so that a file of the user is never
+mistaken for it. Journals of the previous versions, named `journal` and
+without the magic line, are only recovered if every line has their format.
+Will work on both Windows and Linux.
+"""
+
+import os
+import re
+import hashlib
+import manifest
+
+JOURNAL_NAME = ".cryptopuck-journal"
+MAGIC = "cryptopuck-journal 1"
+LEGACY_JOURNAL_NAME = "journal"
+LEGACY_LINES = (re.compile(r"^session \d+$"),
+                re.compile(r"^[0-9a-f]{128} \d+$"))
+
+
+def path_hash(salt, real_filepath):
+    """ Hashes the path of a file so that it is not revealed by the journal.
+
+    Arguments:
+        salt            The random salt of the journal
+        real_filepath   The path of the file relative to the source folder
+
+    Return:
+        The digest of the salted path
+    """
+    return hashlib.sha256(salt + real_filepath.encode("UTF-8")).digest()
+
+
+class Journal():
+    def __init__(self, folder, session, salt=None, finished=()):
+        """ Starts a new journal for the session.
+
+        Arguments:
+            folder      The folder with the encrypted files, ending with a
+                        separator
+            session     The number of the session being encrypted
+            salt        The salt of the path hashes, a new one if None
+            finished    The path hashes of the files encrypted by the
+                        interrupted sessions, see `recover`
+        """
+        self.path = folder + JOURNAL_NAME
+        self.salt = salt if salt is not None else os.urandom(16)
+        self.file = open(self.path, "w")
+        self.file.write("%s\nsession %d\nsalt %s\n"
+                        % (MAGIC, session, self.salt.hex()))
+        for digest in finished:
+            self.file.write("done %s\n" % digest.hex())
+        self.sync()
+
+    def path_hash(self, real_filepath):
+        """ Hashes the path of a file with the salt of the journal.
+
+        Arguments:
+            real_filepath   The path of the file relative to the source folder
+
+        Return:
+            The digest of the salted path
+        """
+        return path_hash(self.salt, real_filepath)
+
+    def commit(self, name, records, sync=True):
+        """ Records that a file has been encrypted.
+
+        Arguments:
+            name        The obscured name of the file
+            records     List of (position of the record in the manifest,
+                        path relative to the source folder) of the files in
+                        it, more than one for bundles (see the `bundle`
+                        module)
+            sync        Whether to wait until the record has reached the
+                        volume, otherwise `sync` should be called later.
+                        The record is passed to the operating system either
+                        way, so that it survives the process being killed.
+        """
+        for position, real_filepath in records:
+            self.file.write("%s %d %s\n" % (
+                name, position, self.path_hash(real_filepath).hex()))
+        if sync:
+            self.sync()
+        else:
+            self.file.flush()
+
+    def sync(self):
+        """ Waits until the journal has reached the volume. """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        """ Removes the journal after the session has been completed. """
+        if self.file.closed:
+            return
+        self.file.close()
+        os.remove(self.path)
+
+
+def find(folder):
+    """ Finds the journal of an interrupted session.
+
+    Arguments:
+        folder          The folder with the encrypted files, ending with a
+                        separator
+
+    Return:
+        path            Path to the journal or None if there is no journal
+    """
+    path = folder + JOURNAL_NAME
+    if os.path.isfile(path):
+        return path
+    path = folder + LEGACY_JOURNAL_NAME
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as journal_file:
+        # The last line is either empty or partially written
+        lines = journal_file.read().split(b"\n")[:-1]
+    lines = [line.decode("ascii", "replace") for line in lines]
+    if not lines or not LEGACY_LINES[0].match(lines[0]):
+        return None
+    if all(LEGACY_LINES[1].match(line) for line in lines[1:]):
+        return path
+    return None
+
+
+def read(folder):
+    """ Reads the journal of an interrupted session.
+
+    Arguments:
+        folder          The folder with the encrypted files, ending with a
+                        separator
+
+    Return:
+        session         The number of the interrupted session or None if there
+                        is no journal
+        records         List of (obscured name, record position) of the
+                        committed files
+        salt            The salt of the path hashes, None for journals of the
+                        previous versions
+        finished        Set of the path hashes of the files encrypted by the
+                        interrupted sessions
+    """
+    path = find(folder)
+    if path is None:
+        return None, [], None, set()
+    with open(path, "r") as journal_file:
+        # The last line is either empty or partially written
+        lines = journal_file.read().split("\n")[:-1]
+    if path.endswith(JOURNAL_NAME):
+        if lines and lines[0] != MAGIC:
+            raise ValueError("Not a journal: " + path)
+        lines = lines[1:]
+    if not lines:
+        return -1, [], None, set()  # Interrupted before anything was written
+    session = int(lines[0].split()[1])
+    salt = None
+    records = []
+    finished = set()
+    for line in lines[1:]:
+        fields = line.split()
+        if fields[0] == "salt":
+            salt = bytes.fromhex(fields[1])
+        elif fields[0] == "done":
+            finished.add(bytes.fromhex(fields[1]))
+        else:
+            # Journals of the previous versions have no path hashes
+            records.append((fields[0], int(fields[1])))
+            if len(fields) > 2:
+                finished.add(bytes.fromhex(fields[2]))
+    return session, records, salt, finished
+
+
+def recover(folder):
+    """ Cleans up after an interrupted encryption.
+
+    The manifest of the interrupted session is closed, keeping only the
+    committed records, and any encrypted files that are neither committed nor
+    part of a previous session are removed.
+
+    Arguments:
+        folder          The folder with the encrypted files, ending with a
+                        separator
+
+    Return:
+        None if there was no interrupted session, otherwise (salt, finished)
+        as returned by `read`, to be passed on to the Journal of the next
+        session
+    """
+    session, records, salt, finished = read(folder)
+    if session is None:
+        return None
+
+    secret_path, map_path = manifest.session_paths(folder, session)
+    if session >= 0 and not records:
+        # Nothing was committed, so the session can be discarded
+        for path in (secret_path, map_path):
+            if os.path.exists(path):
+                os.remove(path)
+    elif session >= 0:
+        with manifest.ManifestReader(map_path) as filenames_map:
+            closed = filenames_map.is_closed()
+        if not closed:
+            manifest.seal(map_path, records)
+
+    # Collect the encrypted files of all the sessions
+    committed = set()
+    legacy_sessions = False
+    for number in manifest.find_sessions(folder):
+        _, map_path = manifest.session_paths(folder, number)
+        if not os.path.isfile(map_path):
+            continue
+        if not manifest.is_manifest(map_path):
+            legacy_sessions = True
+            continue
+        with manifest.ManifestReader(map_path) as filenames_map:
+            committed.update(filenames_map.names())
+    # The encrypted files of legacy sessions cannot be told apart from the
+    # partially encrypted ones, so it is safer to leave them all in place
+    if not legacy_sessions:
+        for name in os.listdir(folder):
+            if manifest.is_obscured_name(name) and name not in committed:
+                print("Removing partially encrypted file: " + name)
+                os.remove(folder + name)
+
+    os.remove(find(folder))
+    return salt, finished
@@ -0,0 +1,583 @@
+"""
+Module to write and read the map between the obscured and the real filepaths.
+
+The map (manifest) is written record by record while the files are being
+encrypted, so that it never has to be kept in memory as a whole. Its layout is:
+
+    header      magic, version and a random nonce prefix (see `HEADER`)
+    records     each record is its length followed by the record encrypted
+                and authenticated with AES (GCM mode). A record is a JSON
+                object with (at least) the obscured `name` and the real `path`
+                of a file.
+    index       the obscured names, which are anyway visible on the volume,
+                sorted and along with the position of their record so that
+                they can be looked up without decrypting the whole map
+    footer      the position of the index and the number of its entries
+
+The index entries are kept in memory in runs of `INDEX_RUN` entries, each of
+which is sorted and moved to a temporary file once it is full. When the
+manifest is closed, the runs are merged into the index, so the memory used
+does not grow with the number of files.
+
+If the manifest was not properly closed (e.g. the volume was removed while it
+was being encrypted) the records that were fully written can still be read.
+
+Every time a volume is encrypted, a new session with its own (encrypted) AES
+secret and manifest is created. The first session uses the `secret` and
+`filenames_map` files, while any following ones have the session number as a
+suffix (e.g. `secret.1` and `filenames_map.1`). Files of the user with the
+same names are not mistaken for a session: the secret has to be as long as an
+RSA modulus and the manifest has to start with its magic bytes, or be a
+legacy JSON map of the size its header declares. A new session never reuses
+the name of an existing file. Will work on both Windows and Linux.
+"""
+
+import os
+import re
+import json
+import heapq
+import struct
+import tempfile
+import collections
+from Crypto.Cipher import AES
+
+# The last byte of the magic is not zero, so it cannot be mistaken for the
+# little endian size of a legacy encrypted JSON map
+MAGIC = b"\x89CPM\r\n\x1a\n"
+VERSION = 1
+# Magic, version, nonce prefix
+HEADER = struct.Struct("<8sB4s")
+RECORD_LENGTH = struct.Struct("<I")
+# Obscured name (raw SHA-512 digest), position of the record
+INDEX_ENTRY = struct.Struct("<64sQ")
+FOOTER_MAGIC = b"CPMINDEX"
+# Magic, position of the index, number of entries
+FOOTER = struct.Struct("<8sQQ")
+TAG_SIZE = 16
+# Index entries kept in memory by a writer, and read at once when merging
+INDEX_RUN = 16384
+INDEX_BLOCK = 1024
+
+SECRET_NAME = "secret"
+MAP_NAME = "filenames_map"
+SESSION_FILE = re.compile(r"^(%s|%s)(?:\.(\d+))?$" % (SECRET_NAME, MAP_NAME))
+# Lengths of the secrets encrypted with RSA keys of 1024 to 8192 bits
+SECRET_SIZES = range(128, 1024 + 1, 64)
+# Size of the original map followed by the IV, see the `streams` module
+LEGACY_HEADER = struct.Struct("<Q16s")
+OBSCURED_NAME = re.compile(r"^[0-9a-f]{128}$")
+
+
+def session_paths(folder, session):
+    """ Returns the paths of the secret and the manifest of a session.
+
+    Arguments:
+        folder          The folder with the encrypted files, ending with a
+                        separator
+        session         The number of the session
+
+    Return:
+        secret_path     Path to the (encrypted) AES secret of the session
+        map_path        Path to the manifest of the session
+    """
+    suffix = "." + str(session) if session else ""
+    return folder + SECRET_NAME + suffix, folder + MAP_NAME + suffix
+
+
+def find_sessions(folder):
+    """ Finds the sessions of an encrypted folder.
+
+    Arguments:
+        folder          The folder with the encrypted files, ending with a
+                        separator
+
+    Return:
+        sessions        Sorted list of the numbers of the sessions that have
+                        an (encrypted) AES secret and a manifest
+    """
+    sessions = set()
+    for name in os.listdir(folder):
+        match = SESSION_FILE.match(name)
+        if match and match.group(1) == SECRET_NAME:
+            session = int(match.group(2) or 0)
+            if is_session(folder, session):
+                sessions.add(session)
+    return sorted(sessions)
+
+
+def is_session(folder, session):
+    """ Checks whether the secret and the manifest of a session have been
+        generated by an encryption rather than being files of the user.
+
+    Arguments:
+        folder          The folder with the encrypted files, ending with a
+                        separator
+        session         The number of the session
+
+    Return:
+        True if both files belong to the session, False otherwise
+    """
+    secret_path, map_path = session_paths(folder, session)
+    if not os.path.isfile(secret_path) or not os.path.isfile(map_path):
+        return False
+    if os.path.getsize(secret_path) not in SECRET_SIZES:
+        return False
+    return is_manifest(map_path) or is_legacy_map(map_path)
+
+
+def new_session(folder, sessions):
+    """ Chooses the number of a new session.
+
+    Arguments:
+        folder          The folder with the encrypted files, ending with a
+                        separator
+        sessions        The existing sessions, see `find_sessions`
+
+    Return:
+        session         A number after the existing sessions, whose secret
+                        and manifest would not overwrite any file
+    """
+    session = sessions[-1] + 1 if sessions else 0
+    while any(os.path.lexists(path)
+              for path in session_paths(folder, session)):
+        session += 1
+    return session
+
+
+def session_files(folder, sessions):
+    """ Returns the names of the secrets and the manifests of the sessions.
+    """
+    return {os.path.basename(path) for session in sessions
+            for path in session_paths(folder, session)}
+
+
+def is_obscured_name(name):
+    """ Checks whether the filename looks like an obscured one. """
+    return OBSCURED_NAME.match(name) is not None
+
+
+def record_cipher(key, header, position):
+    """ Creates the cipher for a single record.
+
+    Arguments:
+        key             The AES secret
+        header          The raw header of the manifest
+        position        The position of the record in the manifest, which
+                        makes the nonce of every record unique
+
+    Return:
+        cipher          The AES (GCM mode) cipher of the record
+    """
+    nonce_prefix = header[-4:]
+    nonce = nonce_prefix + struct.pack(">Q", position)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+    cipher.update(header)
+    return cipher
+
+
+def is_manifest(filename):
+    """ Checks whether the file is a streamed manifest. """
+    with open(filename, "rb") as manifest_file:
+        return manifest_file.read(len(MAGIC)) == MAGIC
+
+
+def is_legacy_map(filename):
+    """ Checks whether the file is a JSON map of the previous versions, i.e.
+        it is as long as the AES blocks of the size in its header. """
+    with open(filename, "rb") as map_file:
+        header = map_file.read(LEGACY_HEADER.size)
+    if len(header) != LEGACY_HEADER.size:
+        return False
+    mapsize = LEGACY_HEADER.unpack(header)[0]
+    return (os.path.getsize(filename) ==
+            LEGACY_HEADER.size + -(-mapsize // AES.block_size) *
+            AES.block_size)
+
+
+def write_index(manifest_file, entries):
+    """ Writes the index and the footer at the current position.
+
+    Arguments:
+        manifest_file   The manifest file object
+        entries         Iterable of the packed index entries, sorted
+    """
+    index_position = manifest_file.tell()
+    count = 0
+    for entry in entries:
+        manifest_file.write(entry)
+        count += 1
+    manifest_file.write(FOOTER.pack(FOOTER_MAGIC, index_position, count))
+
+
+def read_run(run_file, position, count):
+    """ Reads the index entries of a run from a temporary file.
+
+    The runs share the file, so its position is set before every block.
+
+    Arguments:
+        run_file        The temporary file object
+        position        The position of the run in the file
+        count           The number of entries in the run
+
+    Return:
+        Generator of the packed index entries
+    """
+    while count:
+        block = min(count, INDEX_BLOCK)
+        run_file.seek(position)
+        data = run_file.read(block * INDEX_ENTRY.size)
+        for offset in range(0, len(data), INDEX_ENTRY.size):
+            yield data[offset:offset + INDEX_ENTRY.size]
+        position += len(data)
+        count -= block
+
+
+def seal(filename, records):
+    """ Closes a manifest that was left unfinished.
+
+    The encryption key is not needed, since the obscured names and the
+    positions of the records are given. Anything after the last of the given
+    records is discarded.
+
+    Arguments:
+        filename        Path to the unfinished manifest
+        records         List of (obscured name, position) of the records that
+                        should be kept
+    """
+    with open(filename, "rb+") as manifest_file:
+        end = HEADER.size
+        if records:
+            last_position = max(position for _, position in records)
+            manifest_file.seek(last_position)
+            length = RECORD_LENGTH.unpack(
+                manifest_file.read(RECORD_LENGTH.size))[0]
+            end = last_position + RECORD_LENGTH.size + length
+        manifest_file.truncate(end)
+        manifest_file.seek(end)
+        write_index(manifest_file, sorted(INDEX_ENTRY.pack(
+            bytes.fromhex(name), position) for name, position in records))
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+
+
+class ManifestWriter():
+    def __init__(self, filename, key):
+        """ Creates a new manifest, overwriting any existing file.
+
+        Arguments:
+            filename    Path to the manifest
+            key         The AES secret to encrypt the records with
+        """
+        self.key = key
+        self.file = open(filename, "wb")
+        self.header = HEADER.pack(MAGIC, VERSION, os.urandom(4))
+        self.file.write(self.header)
+        self.records = 0
+        # Packed index entries of the current run, sorted once it is full
+        self.index = []
+        # Temporary file with the full runs and their (position, entries)
+        self.run_file = None
+        self.runs = []
+
+    def add(self, name, path, **attributes):
+        """ Appends a record to the manifest.
+
+        Arguments:
+            name        The obscured name, a SHA-512 hex digest
+            path        The real path of the file
+            attributes  Any additional (JSON serializable) attributes
+
+        Return:
+            position    The position of the record in the manifest
+        """
+        record = dict(attributes, name=name, path=path)
+        plaintext = json.dumps(record).encode("UTF-8")
+        position = self.file.tell()
+        cipher = record_cipher(self.key, self.header, position)
+        ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+        self.file.write(RECORD_LENGTH.pack(len(ciphertext) + TAG_SIZE))
+        self.file.write(ciphertext)
+        self.file.write(tag)
+        self.index.append(INDEX_ENTRY.pack(bytes.fromhex(name), position))
+        if len(self.index) >= INDEX_RUN:
+            self.spill_index()
+        self.records += 1
+        return position
+
+    def spill_index(self):
+        """ Sorts the entries of the current run and moves them to the
+            temporary file. """
+        if self.run_file is None:
+            self.run_file = tempfile.TemporaryFile()
+        self.index.sort()
+        self.run_file.seek(0, os.SEEK_END)
+        self.runs.append((self.run_file.tell(), len(self.index)))
+        self.run_file.write(b"".join(self.index))
+        self.index = []
+
+    def __len__(self):
+        return self.records
+
+    def flush(self, durable=False):
+        """ Makes sure the written records reach the file.
+
+        Arguments:
+            durable     Whether to also wait until they reach the device
+        """
+        self.file.flush()
+        if durable:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        """ Writes the index and the footer and closes the manifest. """
+        if self.file.closed:
+            return
+        if self.run_file is None:
+            write_index(self.file, sorted(self.index))
+        else:
+            self.spill_index()
+            write_index(self.file, heapq.merge(
+                *[read_run(self.run_file, position, count)
+                  for position, count in self.runs]))
+            self.run_file.close()
+            self.run_file = None
+            self.runs = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ManifestReader():
+    def __init__(self, filename, key=None):
+        """ Opens an existing manifest.
+
+        Arguments:
+            filename    Path to the manifest
+            key         The AES secret to decrypt the records with. Can be
+                        omitted if only the obscured names are needed.
+        """
+        self.key = key
+        self.file = open(filename, "rb")
+        self.header = self.file.read(HEADER.size)
+        magic, version, _ = HEADER.unpack(self.header)
+        if magic != MAGIC:
+            raise ValueError("Not a manifest: " + filename)
+        if version != VERSION:
+            raise ValueError("Unsupported manifest version: %d" % version)
+        # Look for the footer, which is missing if the manifest was not closed
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        self.index_position = size
+        self.index_entries = None
+        if size >= HEADER.size + FOOTER.size:
+            self.file.seek(size - FOOTER.size)
+            magic, position, entries = FOOTER.unpack(
+                self.file.read(FOOTER.size))
+            if magic == FOOTER_MAGIC:
+                self.index_position = position
+                self.index_entries = entries
+
+    def read_record(self, position):
+        """ Reads and decrypts the record at the given position.
+
+        Return:
+            record      The decrypted record or None if it is truncated
+            position    The position of the next record
+        """
+        self.file.seek(position)
+        length = self.file.read(RECORD_LENGTH.size)
+        if len(length) != RECORD_LENGTH.size:
+            return None, position
+        length = RECORD_LENGTH.unpack(length)[0]
+        sealed = self.file.read(length)
+        if len(sealed) != length or length < TAG_SIZE:
+            return None, position
+        cipher = record_cipher(self.key, self.header, position)
+        plaintext = cipher.decrypt_and_verify(sealed[:-TAG_SIZE],
+                                              sealed[-TAG_SIZE:])
+        record = json.loads(plaintext.decode("UTF-8"))
+        return record, position + RECORD_LENGTH.size + length
+
+    def __iter__(self):
+        """ Iterates over the records in the order they were written. """
+        position = HEADER.size
+        while position < self.index_position:
+            try:
+                record, position = self.read_record(position)
+            except ValueError:
+                # Only the last record of an unfinished manifest may have
+                # been partially written
+                if self.index_entries is not None:
+                    raise
+                record = None
+            if record is None:
+                break  # The rest of an unfinished manifest is lost
+            yield record
+
+    def lookup(self, name):
+        """ Finds the records of an obscured name.
+
+        The sorted index is binary searched, so only the matching records are
+        decrypted. Manifests without an index are searched sequentially.
+
+        Arguments:
+            name        The obscured name, a SHA-512 hex digest
+
+        Return:
+            records     List with the matching records
+        """
+        if self.index_entries is None:
+            return [record for record in self if record["name"] == name]
+
+        records = []
+        entry = self.find_entry(name)
+        while entry < self.index_entries:
+            entry_name, position = self.index_entry(entry)
+            if entry_name.hex() != name:
+                break
+            records.append(self.read_record(position)[0])
+            entry += 1
+        return records
+
+    def find_entry(self, name):
+        """ Binary searches the index for the first entry of a name.
+
+        Return:
+            entry       The index of the first entry that is not smaller than
+                        the name
+        """
+        try:
+            key = bytes.fromhex(name)
+        except ValueError:
+            key = b""
+        low, high = 0, self.index_entries
+        while low < high:
+            middle = (low + high) // 2
+            if self.index_entry(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __contains__(self, name):
+        """ Checks whether the obscured name is in the manifest.
+
+        Only the index is searched, so no records are decrypted.
+        """
+        if self.index_entries is None:
+            return any(record["name"] == name for record in self)
+        entry = self.find_entry(name)
+        return (entry < self.index_entries and
+                self.index_entry(entry)[0].hex() == name)
+
+    def is_closed(self):
+        """ Checks whether the manifest has an index. """
+        return self.index_entries is not None
+
+    def entries(self):
+        """ Iterates over the entries of the index in their (sorted) order.
+
+        The index is read in blocks of `INDEX_BLOCK` entries, seeking before
+        every block in case other methods are called in between.
+
+        Return:
+            Generator of (raw obscured name, record position)
+        """
+        for first in range(0, self.index_entries or 0, INDEX_BLOCK):
+            count = min(INDEX_BLOCK, self.index_entries - first)
+            self.file.seek(self.index_position + first * INDEX_ENTRY.size)
+            data = self.file.read(count * INDEX_ENTRY.size)
+            yield from INDEX_ENTRY.iter_unpack(data)
+
+    def names(self):
+        """ Iterates over the obscured names in the index.
+
+        The records are not decrypted, so no key is needed.
+        """
+        for name, _ in self.entries():
+            yield name.hex()
+
+    def shared_names(self):
+        """ Finds the obscured names with more than one record, i.e. bundles
+            and files with copies.
+
+        The records of a name are next to each other in the sorted index, so
+        it is read once without counting every name.
+
+        Return:
+            names       Set of the shared obscured names
+        """
+        if self.index_entries is None:
+            names = collections.Counter(record["name"] for record in self)
+            return {name for name, count in names.items() if count > 1}
+        shared = set()
+        previous = None
+        for name, _ in self.entries():
+            if name == previous:
+                shared.add(name.hex())
+            previous = name
+        return shared
+
+    def index_entry(self, entry):
+        """ Returns the obscured name and record position of an entry. """
+        self.file.seek(self.index_position + entry * INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack(self.file.read(INDEX_ENTRY.size))
+
+    def __len__(self):
+        if self.index_entries is not None:
+            return self.index_entries
+        return sum(1 for _ in self)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LegacyManifest():
+    def __init__(self, filenames_map):
+        """ Wraps the JSON map of the previous versions as a manifest.
+
+        Arguments:
+            filenames_map   Dictionary with the obscured filenames as keys
+                            and the real paths as values
+        """
+        self.filenames_map = filenames_map
+
+    def __iter__(self):
+        for name, path in self.filenames_map.items():
+            yield {"name": name, "path": path}
+
+    def lookup(self, name):
+        if name not in self.filenames_map:
+            return []
+        return [{"name": name, "path": self.filenames_map[name]}]
+
+    def __contains__(self, name):
+        return name in self.filenames_map
+
+    def shared_names(self):
+        return set()  # Every file has its own record
+
+    def __len__(self):
+        return len(self.filenames_map)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
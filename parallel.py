@@ -0,0 +1,116 @@
+"""
+Module to run the encryption and decryption jobs in parallel.
+
+Encrypting or decrypting a file does not depend on any other file, therefore
+the work can be spread over multiple processes to make use of all the
+available cores. Will work on both Windows and Linux.
+"""
+
+import contextlib
+import concurrent.futures
+
+
+def run_jobs(job, arguments, jobs=1, on_done=None, executor=None,
+             on_error=None):
+    """ Runs the job for each of the supplied arguments.
+
+        With a single job everything is run sequentially in the current
+        process. Otherwise the work is spread over a pool of worker processes,
+        while keeping only a bounded number of pending jobs so that huge
+        volumes do not have to be queued up in memory.
+
+        Arguments:
+            job             The (picklable) function to run
+            arguments       Iterable of argument tuples, one for each job
+            jobs            The number of worker processes to use
+            on_done         Function called in the current process with the
+                            arguments of each job after it has finished
+            executor        An existing pool of `jobs` workers to use, which
+                            may be shared with other callers
+            on_error        Function called in the current process with the
+                            exception and the arguments of each job that
+                            failed. If None, the first exception is raised.
+    """
+    if executor:
+        submit_jobs(executor, job, arguments, jobs, on_done, on_error)
+        return
+
+    if jobs <= 1:
+        for args in arguments:
+            try:
+                job(*args)
+            except Exception as error:
+                if not on_error:
+                    raise
+                on_error(error, *args)
+                continue
+            if on_done:
+                on_done(*args)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        submit_jobs(executor, job, arguments, jobs, on_done, on_error)
+
+
+def submit_jobs(executor, job, arguments, jobs, on_done=None, on_error=None):
+    """ Runs the jobs in the executor and waits until they are finished.
+
+        Arguments:
+            executor        The pool of workers
+            job             The (picklable) function to run
+            arguments       Iterable of argument tuples, one for each job
+            jobs            The number of workers of the pool
+            on_done         Function called in the current process with the
+                            arguments of each job after it has finished
+            on_error        Function called in the current process with the
+                            exception and the arguments of each job that
+                            failed. If None, the first exception is raised.
+    """
+    max_pending = jobs * 4
+    pending = dict()
+
+    def finish(futures):
+        for future in futures:
+            args = pending.pop(future)
+            try:
+                future.result()  # Propagate any errors from the workers
+            except Exception as error:
+                if not on_error:
+                    raise
+                on_error(error, *args)
+                continue
+            if on_done:
+                on_done(*args)
+
+    try:
+        for args in arguments:
+            pending[executor.submit(job, *args)] = args
+            if len(pending) >= max_pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                finish(done)
+        finish(concurrent.futures.as_completed(list(pending)))
+    finally:
+        # Do not leave any jobs behind in a shared pool
+        for future in pending:
+            future.cancel()
+        concurrent.futures.wait(pending)
+
+
+@contextlib.contextmanager
+def shared_executor(jobs=1):
+    """ Creates a pool of worker processes that can be shared between
+        multiple `run_jobs` calls, e.g. for many volumes.
+
+        Arguments:
+            jobs            The number of worker processes to use
+
+        Return:
+            Context manager of the pool, or of None for a single job since
+            everything is then run in the current process
+    """
+    if jobs <= 1:
+        yield None
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield executor
@@ -0,0 +1,127 @@
+"""
+Module to stream a file through a cipher while overlapping disk I/O.
+
+Reading from the source device, running the cipher and writing to the
+destination device are done in three separate stages, so that they can run at
+the same time instead of one after the other. A small pool of preallocated
+buffers is reused between the stages, which avoids allocating new objects for
+every chunk. Files that fit in a single chunk are processed inline, since
+starting the stages would cost more than it saves. Will work on both Windows
+and Linux.
+"""
+
+import queue
+import threading
+
+
+def read_chunk(infile, buffer):
+    """ Fills the buffer with data from the file.
+
+    Arguments:
+        infile          The file object to read from
+        buffer          The bytearray to read into
+
+    Return:
+        length          The number of bytes read, which is smaller than the
+                        size of the buffer only when the end of the file was
+                        reached
+    """
+    view = memoryview(buffer)
+    length = 0
+    while length < len(buffer):
+        read = infile.readinto(view[length:])
+        if not read:
+            break
+        length += read
+    return length
+
+
+def run(infile, outfile, transform, chunksize=64*1024, buffers=3, reserve=0):
+    """ Streams the infile through the transform into the outfile.
+
+    Arguments:
+        infile          The file object to read from
+        outfile         The file object to write to
+        transform       Function called with a bytearray and the number of
+                        bytes read into it. It should process the data in
+                        place and return the number of bytes to be written
+                        from the beginning of the bytearray.
+        chunksize       The size of each buffer
+        buffers         The number of buffers shared between the stages
+        reserve         Extra space at the end of each buffer, which is not
+                        read into but can be used by the transform to append
+                        data to the chunk (e.g. an authentication tag)
+    """
+    first = bytearray(chunksize + reserve)
+    length = read_chunk(infile, memoryview(first)[:chunksize])
+    if length < chunksize:
+        # The whole file has been read
+        if length:
+            outfile.write(memoryview(first)[:transform(first, length)])
+        return
+
+    free_buffers = queue.Queue()
+    for _ in range(buffers - 1):
+        free_buffers.put(bytearray(chunksize + reserve))
+    read_buffers = queue.Queue()
+    read_buffers.put((first, length))
+    written_buffers = queue.Queue()
+    errors = []
+
+    def reader():
+        try:
+            while True:
+                buffer = free_buffers.get()
+                if buffer is None:
+                    break  # Stop reading if something went wrong
+                length = read_chunk(infile, memoryview(buffer)[:chunksize])
+                if length:
+                    read_buffers.put((buffer, length))
+                if length < chunksize:
+                    break
+        except Exception as e:
+            errors.append(e)
+        finally:
+            read_buffers.put(None)
+
+    def writer():
+        try:
+            while True:
+                item = written_buffers.get()
+                if item is None:
+                    break
+                buffer, length = item
+                outfile.write(memoryview(buffer)[:length])
+                free_buffers.put(buffer)
+        except Exception as e:
+            errors.append(e)
+            # Unblock the reader so that it stops
+            free_buffers.put(None)
+            # Keep consuming so the cipher stage does not block
+            while written_buffers.get() is not None:
+                pass
+
+    reader_thread = threading.Thread(target=reader)
+    writer_thread = threading.Thread(target=writer)
+    reader_thread.start()
+    writer_thread.start()
+
+    try:
+        while not errors:
+            item = read_buffers.get()
+            if item is None:
+                break
+            buffer, length = item
+            written_buffers.put((buffer, transform(buffer, length)))
+    except Exception as e:
+        errors.append(e)
+        free_buffers.put(None)
+    finally:
+        written_buffers.put(None)
+        writer_thread.join()
+        # Make sure the reader is not left waiting for a buffer
+        free_buffers.put(None)
+        reader_thread.join()
+
+    if errors:
+        raise errors[0]
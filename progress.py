@@ -0,0 +1,156 @@
+"""
+Module to keep track of the progress of an encryption or a decryption.
+
+The files and bytes that have been processed, the current throughput, the
+estimated time left and the time spent in every stage (e.g. walking the
+source folder or encrypting the files) are reported to a callback as a
+dictionary, whenever something changes. The callback is called from the
+thread that runs the encryption or decryption, so it should return quickly.
+Will work on both Windows and Linux.
+"""
+
+import time
+import datetime
+import contextlib
+import collections
+
+MB = 1024 * 1024
+
+
+class ProgressTracker():
+    def __init__(self, callback=None, window=10):
+        """ Starts tracking the progress.
+
+        Arguments:
+            callback    Function called with a snapshot (see `snapshot`) every
+                        time the progress changes. Nothing is reported if None.
+            window      The number of seconds over which the current
+                        throughput is averaged
+        """
+        self.callback = callback
+        self.window = window
+        self.files_total = 0
+        self.bytes_total = 0
+        self.files_done = 0
+        self.bytes_done = 0
+        self.stages = collections.OrderedDict()
+        self.current_stage = None
+        self.stage_started = None
+        self.finished = False
+        # Whether files are still being added to the totals, in which case
+        # the time left is not estimated
+        self.counting = False
+        self.started = time.monotonic()
+        # (time, bytes done) samples within the window
+        self.samples = collections.deque([(self.started, 0)])
+
+    @property
+    def enabled(self):
+        """ Whether anyone is interested in the progress. """
+        return self.callback is not None
+
+    def add_total(self, files, size):
+        """ Adds to the number of files and bytes to be processed. """
+        self.files_total += files
+        self.bytes_total += size
+        self.report()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Context manager that times a stage of the work.
+
+        The time of stages that are entered more than once adds up.
+        """
+        self.current_stage = name
+        self.stage_started = time.monotonic()
+        self.stages.setdefault(name, 0)
+        self.report()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.monotonic() - self.stage_started
+            self.current_stage = None
+            self.stage_started = None
+
+    def file_done(self, size):
+        """ Records that a file of the given size has been processed. """
+        now = time.monotonic()
+        self.files_done += 1
+        self.bytes_done += size
+        self.samples.append((now, self.bytes_done))
+        # Keep a single sample older than the window
+        while len(self.samples) > 2 and self.samples[1][0] < now - self.window:
+            self.samples.popleft()
+        self.report()
+
+    def finish(self):
+        """ Records that all the work has been done. """
+        self.finished = True
+        self.report()
+
+    def rate(self):
+        """ Returns the current throughput in bytes per second. """
+        first_time, first_bytes = self.samples[0]
+        last_time, last_bytes = self.samples[-1]
+        if last_time <= first_time:
+            return 0
+        return (last_bytes - first_bytes) / (last_time - first_time)
+
+    def snapshot(self):
+        """ Describes the current progress.
+
+        Return:
+            snapshot    Dictionary with the `stage` being run, the number of
+                        `files_done` and `files_total`, `bytes_done` and
+                        `bytes_total`, the current throughput (`mb_per_s`),
+                        the estimated seconds left (`eta_seconds`, None
+                        while unknown or still counting), the
+                        `elapsed_seconds`, the seconds spent in each of the
+                        `stages` and whether it has `finished`
+        """
+        now = time.monotonic()
+        stages = dict(self.stages)
+        if self.current_stage:
+            stages[self.current_stage] += now - self.stage_started
+        rate = self.rate()
+        eta = None
+        if self.finished:
+            eta = 0
+        elif rate and self.bytes_total and not self.counting:
+            eta = max(0, self.bytes_total - self.bytes_done) / rate
+        return {
+            "stage": self.current_stage,
+            "files_done": self.files_done,
+            "files_total": self.files_total,
+            "bytes_done": self.bytes_done,
+            "bytes_total": self.bytes_total,
+            "mb_per_s": round(rate / MB, 3),
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "elapsed_seconds": round(now - self.started, 3),
+            "stages": {name: round(seconds, 3)
+                       for name, seconds in stages.items()},
+            "finished": self.finished,
+        }
+
+    def report(self):
+        """ Passes a snapshot of the progress to the callback. """
+        if self.callback:
+            self.callback(self.snapshot())
+
+
+def describe(snapshot):
+    """ Formats a snapshot (see `ProgressTracker.snapshot`) as a single line.
+
+    Return:
+        description     E.g. "encrypt: 12/100 files, 120.0/1000.0 MB,
+                        5.2 MB/s, ETA 0:02:49"
+    """
+    if snapshot["eta_seconds"] is None:
+        eta = "unknown"
+    else:
+        eta = str(datetime.timedelta(seconds=int(snapshot["eta_seconds"])))
+    return "%s: %d/%d files, %.1f/%.1f MB, %.1f MB/s, ETA %s" % (
+        snapshot["stage"] or ("done" if snapshot["finished"] else "idle"),
+        snapshot["files_done"], snapshot["files_total"],
+        snapshot["bytes_done"] / MB, snapshot["bytes_total"] / MB,
+        snapshot["mb_per_s"], eta)
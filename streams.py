@@ -0,0 +1,348 @@
+"""
+Module with file objects that encrypt or decrypt the data streamed through
+them.
+
+An `EncryptingWriter` encrypts the data written to it into any binary file
+object (a file, a pipe, a socket, a BytesIO etc) and a `DecryptingReader`
+decrypts any binary file object as it is being read, so that the encrypted
+files can be produced and consumed without going through paths or temporary
+files on the disk. Both of them use the format of the `container` module, or
+the legacy one, and only keep a single segment in memory. Errors are raised
+as exceptions, e.g. a ValueError if the encrypted data is corrupted or
+truncated, so they can be embedded in other applications. The underlying
+file objects are not closed. Will work on both Windows and Linux.
+"""
+
+import io
+import os
+import struct
+import zlib
+from Crypto.Cipher import AES
+import compression
+import container
+import pipeline
+
+# Size of the original file followed by the IV
+LEGACY_HEADER = struct.Struct("<Q16s")
+
+
+class EncryptingWriter(io.RawIOBase):
+    def __init__(self, key, outfile, filesize,
+                 segment_size=container.DEFAULT_SEGMENT_SIZE, flags=0,
+                 legacy=False):
+        """ Encrypts the data written to it into a file object.
+
+        The header of the encrypted file is written right away, so the size
+        of the clear text has to be known in advance. Closing the writer
+        encrypts the last segment and raises a ValueError if a different
+        number of bytes was written.
+
+        Arguments:
+            key             The AES secret
+            outfile         The binary file object to write the encrypted
+                            data to
+            filesize        The size of the clear text that will be written
+            segment_size    The size of the segments, must be divisible by 16
+            flags           The flags of the container header. The clear
+                            text is compressed if FLAG_COMPRESSED is set.
+            legacy          Whether to encrypt the data as a single AES-CBC
+                            stream, which is the format of the previous
+                            versions
+        """
+        self.key = key
+        self.outfile = outfile
+        self.filesize = filesize
+        self.written = 0
+        self.index = 0
+        self.compressor = None
+        # The segment being filled, with room for its tag
+        self.segment = bytearray(segment_size + container.TAG_SIZE)
+        self.segment_size = segment_size
+        self.length = 0
+        if legacy:
+            self.header = None
+            iv = os.urandom(16)
+            self.encryptor = AES.new(key, AES.MODE_CBC, iv)
+            outfile.write(LEGACY_HEADER.pack(filesize, iv))
+            return
+        self.header = container.new_header(filesize, segment_size, flags)
+        if flags & container.FLAG_COMPRESSED:
+            self.compressor = zlib.compressobj(compression.DEFAULT_LEVEL)
+        outfile.write(self.header.raw)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """ Encrypts the data, writing every segment that gets filled.
+
+        Return:
+            length      The number of bytes written, which is always all of
+                        them
+        """
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        view = memoryview(data).cast("B")
+        length = len(view)
+        self.written += length
+        if self.written > self.filesize:
+            raise ValueError("More data than the size of the file")
+        if self.compressor:
+            view = memoryview(self.compressor.compress(view))
+        self.append(view)
+        return length
+
+    def append(self, view):
+        """ Copies the data to the current segment. """
+        while view:
+            copied = min(self.segment_size - self.length, len(view))
+            self.segment[self.length:self.length + copied] = view[:copied]
+            self.length += copied
+            view = view[copied:]
+            if self.length == self.segment_size:
+                self.seal()
+
+    def seal(self):
+        """ Encrypts and writes the current segment. """
+        length = self.length
+        if self.header:
+            length = container.encrypt_segment(self.key, self.header,
+                                               self.index, self.segment,
+                                               length)
+        else:
+            # Only the last chunk may need to be padded
+            if length % 16 != 0:
+                padding = 16 - length % 16
+                self.segment[length:length + padding] = b' ' * padding
+                length += padding
+            view = memoryview(self.segment)[:length]
+            self.encryptor.encrypt(view, output=view)
+        self.outfile.write(memoryview(self.segment)[:length])
+        self.index += 1
+        self.length = 0
+
+    def close(self):
+        """ Encrypts the remaining data and checks the size of the file. """
+        if self.closed:
+            return
+        try:
+            if self.compressor:
+                self.append(memoryview(self.compressor.flush()))
+            if self.length:
+                self.seal()
+            if self.written != self.filesize:
+                raise ValueError("Expected %d bytes, got %d" %
+                                 (self.filesize, self.written))
+        finally:
+            super().close()
+
+    def __exit__(self, error_type, *args):
+        if error_type is not None:
+            # Do not hide the error with the one of the incomplete file
+            super().close()
+        self.close()
+
+
+class DecryptingReader(io.RawIOBase):
+    def __init__(self, key, infile, chunksize=container.DEFAULT_SEGMENT_SIZE):
+        """ Decrypts a file object as it is being read.
+
+        The header is read right away, while the segments are decrypted and
+        authenticated (and decompressed) one by one as they are needed. The
+        file object only has to be seekable for `seek` to be used. A
+        ValueError is raised while reading if the file has been tampered
+        with or is truncated.
+
+        Arguments:
+            key             The AES secret
+            infile          The encrypted binary file object, positioned at
+                            its beginning
+            chunksize       Size of the chunks to read from legacy files.
+                            Must be divisible by 16.
+
+        Attributes:
+            filesize        The size of the clear text
+        """
+        self.key = key
+        self.infile = infile
+        self.index = 0
+        self.produced = 0
+        self.decompressor = None
+        self.pending = memoryview(b"")
+        self.eof = False
+        # Legacy files start with their size instead of the magic bytes
+        raw = bytearray(len(container.MAGIC))
+        if pipeline.read_chunk(infile, raw) != len(raw):
+            raise ValueError("Truncated header")
+        if raw == container.MAGIC:
+            rest = bytearray(container.HEADER.size - len(raw))
+            rest = rest[:pipeline.read_chunk(infile, rest)]
+            self.header = container.parse_header(bytes(raw + rest))
+            self.filesize = self.header.filesize
+            self.chunksize = self.header.segment_size + container.TAG_SIZE
+            if self.header.flags & container.FLAG_COMPRESSED:
+                self.decompressor = zlib.decompressobj()
+        else:
+            rest = bytearray(LEGACY_HEADER.size - len(raw))
+            if pipeline.read_chunk(infile, rest) != len(rest):
+                raise ValueError("Truncated header")
+            self.header = None
+            self.filesize, iv = LEGACY_HEADER.unpack(bytes(raw + rest))
+            self.decryptor = AES.new(key, AES.MODE_CBC, iv)
+            self.chunksize = chunksize
+        self.chunk = bytearray(self.chunksize)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self.infile.seekable()
+
+    def tell(self):
+        return self.produced - len(self.pending)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """ Moves to a position of the decrypted file.
+
+        Only the segment (or the AES block of a legacy file) with the position
+        is decrypted once reading continues. Compressed files have to be
+        decompressed up to the position, from the current one when moving
+        forward and from their beginning otherwise.
+
+        Arguments:
+            offset      The position, relative to `whence`
+            whence      io.SEEK_SET, io.SEEK_CUR or io.SEEK_END
+
+        Return:
+            position    The new position, which is never past the end of the
+                        file
+        """
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if whence == io.SEEK_CUR:
+            offset += self.tell()
+        elif whence == io.SEEK_END:
+            offset += self.filesize
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid whence: %d" % whence)
+        if offset < 0:
+            raise ValueError("Negative seek position: %d" % offset)
+        offset = min(offset, self.filesize)
+
+        if self.decompressor:
+            if offset < self.tell():
+                self.infile.seek(container.HEADER.size)
+                self.rewind(0, 0)
+                self.decompressor = zlib.decompressobj()
+        elif self.header:
+            index = offset // self.header.segment_size
+            self.infile.seek(container.segment_offset(self.header, index))
+            self.rewind(index, index * self.header.segment_size)
+        else:
+            # The IV of every block is the ciphertext of the previous one
+            block = offset // AES.block_size
+            self.infile.seek(LEGACY_HEADER.size +
+                             (block - 1) * AES.block_size)
+            iv = bytearray(AES.block_size)
+            if pipeline.read_chunk(self.infile, iv) != len(iv):
+                raise ValueError("Truncated file")
+            self.decryptor = AES.new(self.key, AES.MODE_CBC, bytes(iv))
+            self.rewind(0, block * AES.block_size)
+        self.skip(offset - self.tell())
+        return offset
+
+    def rewind(self, index, produced):
+        """ Continues reading from the start of a segment or block.
+
+        Arguments:
+            index       The index of the next segment
+            produced    The position of the decrypted file it starts at
+        """
+        self.index = index
+        self.produced = produced
+        self.pending = memoryview(b"")
+        self.eof = False
+
+    def skip(self, length):
+        """ Decrypts and discards data up to the given length. """
+        while length > 0:
+            while not self.pending and not self.eof:
+                self.pending = self.next_chunk()
+            skipped = min(length, len(self.pending))
+            if not skipped:
+                break
+            self.pending = self.pending[skipped:]
+            length -= skipped
+
+    def readinto(self, buffer):
+        """ Reads decrypted data into the buffer.
+
+        Return:
+            length      The number of bytes read, 0 at the end of the file
+        """
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        view = memoryview(buffer).cast("B")
+        while not self.pending and not self.eof:
+            self.pending = self.next_chunk()
+        length = min(len(view), len(self.pending))
+        view[:length] = self.pending[:length]
+        self.pending = self.pending[length:]
+        return length
+
+    def next_chunk(self):
+        """ Decrypts the next part of the file.
+
+        Return:
+            data        Memoryview of the decrypted data, which is valid until
+                        the next call
+        """
+        if self.decompressor and self.decompressor.unconsumed_tail:
+            # Decompress a segment in steps, so that highly compressed data
+            # does not expand all at once
+            data = self.decompressor.decompress(
+                self.decompressor.unconsumed_tail, self.chunksize)
+            return self.produce(data)
+
+        length = pipeline.read_chunk(self.infile, self.chunk)
+        if not length:
+            return self.finish()
+        if self.header:
+            length = container.decrypt_segment(self.key, self.header,
+                                               self.index, self.chunk,
+                                               length)
+        else:
+            if length % 16 != 0:
+                raise ValueError("Truncated file")
+            view = memoryview(self.chunk)[:length]
+            self.decryptor.decrypt(view, output=view)
+            # Drop the padding of the last chunk
+            length = min(length, self.filesize - self.produced)
+        self.index += 1
+        data = memoryview(self.chunk)[:length]
+        if self.decompressor:
+            data = self.decompressor.decompress(data, self.chunksize)
+        return self.produce(data)
+
+    def produce(self, data):
+        """ Keeps track of the size of the decrypted data. """
+        self.produced += len(data)
+        if self.produced > self.filesize:
+            raise ValueError("More data than the size of the file")
+        if not self.header and self.produced == self.filesize:
+            # The rest of a legacy file is padding
+            self.eof = True
+        return memoryview(data)
+
+    def finish(self):
+        """ Checks that the whole file has been decrypted. """
+        self.eof = True
+        data = b""
+        if self.decompressor:
+            data = self.decompressor.flush()
+            if not self.decompressor.eof or self.decompressor.unused_data:
+                raise ValueError("Incomplete compressed stream")
+        data = self.produce(data)
+        if self.produced != self.filesize:
+            raise ValueError("Truncated file")
+        return data
@@ -0,0 +1,63 @@
+"""
+Module to list the volumes that are encrypted or decrypted in a batch.
+
+Encrypting or decrypting many volumes in a row from a single process means
+that the RSA key is parsed once and the worker processes are started once
+for all of them. The volumes are given either as a list file, with the source
+and the destination folder of each volume on a line separated by a tab, or
+as a folder whose every subfolder is a volume. Will work on both Windows and
+Linux.
+"""
+
+import os
+
+
+def read_list(filename):
+    """ Reads the source and destination folders of the volumes.
+
+    Empty lines and lines starting with `#` are skipped.
+
+    Arguments:
+        filename        Path to the list, with a `source<TAB>destination`
+                        pair on every line
+
+    Return:
+        volumes         List of (source, destination) of the volumes
+    """
+    volumes = []
+    with open(filename, "r") as list_file:
+        for number, line in enumerate(list_file, 1):
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            folders = line.split("\t")
+            if len(folders) != 2:
+                raise ValueError("Expected source<TAB>destination on line "
+                                 "%d of %s" % (number, filename))
+            volumes.append((folders[0], folders[1]))
+    return volumes
+
+
+def find(folder, destination, is_volume=None):
+    """ Finds the volumes in the subfolders of a folder.
+
+    Arguments:
+        folder          The folder whose subfolders are the volumes
+        destination     The folder where the volumes end up, each in a
+                        subfolder with the same name. May be the same as
+                        the folder.
+        is_volume       Function called with the path of a subfolder that
+                        returns whether it is a volume. Every subfolder is a
+                        volume if None.
+
+    Return:
+        volumes         Sorted list of (source, destination) of the volumes
+    """
+    volumes = []
+    for entry in os.scandir(folder):
+        if not entry.is_dir():
+            continue
+        if is_volume and not is_volume(entry.path + os.sep):
+            continue
+        volumes.append((entry.path, os.path.join(destination, entry.name)))
+    return sorted(volumes)
@@ -0,0 +1,85 @@
+"""
+Module to walk a folder tree while it is being encrypted.
+
+The files are yielded as soon as the folder they are in has been listed, so
+the encryption can start before the whole tree has been walked. Every folder
+is listed with `os.scandir`, whose entries already know whether they are
+files or folders and cache their stat, so that no extra system calls are
+needed for them. The folders that have been walked are recorded, so that the
+ones emptied by an in-place encryption can be removed without walking the
+tree again. Will work on both Windows and Linux.
+"""
+
+import os
+
+
+class TreeWalker():
+    def __init__(self, folder):
+        """ Prepares to walk the folder.
+
+        Arguments:
+            folder      The folder to walk, ending with a separator
+        """
+        self.folder = folder
+        # Every subfolder that has been walked, parents before children
+        self.directories = []
+
+    def __iter__(self):
+        """ Walks the tree, similarly to `os.walk`.
+
+        Symbolic links to folders are not followed and folders that cannot
+        be listed are skipped.
+
+        Return:
+            Generator of (DirEntry, relative path) of the files
+        """
+        pending = [(self.folder, "")]
+        while pending:
+            dirpath, relative_dirpath = pending.pop()
+            try:
+                entries = os.scandir(dirpath)
+            except OSError:
+                continue
+            subfolders = []
+            with entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if not is_dir:
+                        yield entry, relative_dirpath + entry.name
+                    elif not entry.is_symlink():
+                        subfolders.append(entry)
+            for entry in reversed(subfolders):
+                self.directories.append(entry.path)
+                pending.append((entry.path,
+                                relative_dirpath + entry.name + os.sep))
+
+    def remove_empty_directories(self):
+        """ Removes the walked subfolders that have been emptied.
+
+        Folders that still contain anything are left in place.
+        """
+        # The children are removed before their parents
+        for directory in reversed(self.directories):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass
+
+
+def largest_first(files):
+    """ Orders the files from the largest to the smallest.
+
+    Starting with the largest files balances the load of parallel workers,
+    since no worker is left encrypting a large file after all the others
+    have finished.
+
+    Arguments:
+        files       List of (path, relative path, stat) of the files
+
+    Return:
+        The sorted list
+    """
+    return sorted(files, key=lambda item: item[2].st_size, reverse=True)